@@ -1,5 +1,21 @@
 from .connection import SMFConnection, create_connection
+from .pool import SMFPool, create_pool
+from .server import SMFServer, create_server, run_server
+from .buffers import BufferPool
 from .filter import ZstdCompressionFilter
 from .filter import ZstdDecompressionFilter
+from .filter import ZstdDictionaries
+from .filter import Lz4CompressionFilter
+from .filter import Lz4DecompressionFilter
+from .filter import AdaptiveCompressionFilter
+from .metrics import Metrics, prometheus_text
+from .tracing import StageProfiler, OpenTelemetryHook
+from .loopback import create_loopback_connection
+from .cache import ResponseCache
+from .singleflight import SingleFlight
+from .replicas import Replicas
+from .sharded import ShardedClient, create_sharded_client
+from .stream import ReplyStream
+from .capture import Capture
 
 __version__ = "0.1.0"
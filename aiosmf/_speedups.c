@@ -0,0 +1,368 @@
+/*
+ * Optional C implementation of the smf frame hot path.
+ *
+ * The pure Python implementation in frame.py and util.py is the reference;
+ * everything here must behave identically. frame.py calls init() once with
+ * the protocol constants and the ChecksumError class before use.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <limits.h>
+#include <stdint.h>
+#include <string.h>
+
+#define HEADER_SIZE 16
+/* checksums of payloads at least this large run without the GIL */
+#define NOGIL_CHECKSUM_SIZE 65536
+
+static PyObject *checksum_error = NULL;
+static unsigned long long max_payload_size = 0;
+static long compression_max = 0;
+static unsigned long has_payload_headers = 0;
+
+/* xxh64, see https://github.com/Cyan4973/xxHash/blob/dev/doc/xxhash_spec.md */
+
+#define PRIME64_1 0x9E3779B185EBCA87ULL
+#define PRIME64_2 0xC2B2AE3D27D4EB4FULL
+#define PRIME64_3 0x165667B19E3779F9ULL
+#define PRIME64_4 0x85EBCA77C2B2AE63ULL
+#define PRIME64_5 0x27D4EB2F165667C5ULL
+
+static inline uint64_t rotl64(uint64_t x, int r) {
+  return (x << r) | (x >> (64 - r));
+}
+
+static inline uint64_t read64(const unsigned char *p) {
+  return (uint64_t)p[0] | ((uint64_t)p[1] << 8) | ((uint64_t)p[2] << 16) |
+         ((uint64_t)p[3] << 24) | ((uint64_t)p[4] << 32) |
+         ((uint64_t)p[5] << 40) | ((uint64_t)p[6] << 48) |
+         ((uint64_t)p[7] << 56);
+}
+
+static inline uint32_t read32(const unsigned char *p) {
+  return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) |
+         ((uint32_t)p[3] << 24);
+}
+
+static inline uint16_t read16(const unsigned char *p) {
+  return (uint16_t)(p[0] | (p[1] << 8));
+}
+
+static inline void write32(unsigned char *p, uint32_t v) {
+  p[0] = (unsigned char)v;
+  p[1] = (unsigned char)(v >> 8);
+  p[2] = (unsigned char)(v >> 16);
+  p[3] = (unsigned char)(v >> 24);
+}
+
+static inline uint64_t xxh64_round(uint64_t acc, uint64_t input) {
+  acc += input * PRIME64_2;
+  acc = rotl64(acc, 31);
+  return acc * PRIME64_1;
+}
+
+static inline uint64_t xxh64_merge_round(uint64_t acc, uint64_t val) {
+  acc ^= xxh64_round(0, val);
+  return acc * PRIME64_1 + PRIME64_4;
+}
+
+static uint64_t xxh64(const unsigned char *p, size_t len) {
+  const unsigned char *end = p + len;
+  uint64_t h;
+
+  if (len >= 32) {
+    const unsigned char *limit = end - 32;
+    uint64_t v1 = PRIME64_1 + PRIME64_2;
+    uint64_t v2 = PRIME64_2;
+    uint64_t v3 = 0;
+    uint64_t v4 = 0 - PRIME64_1;
+    do {
+      v1 = xxh64_round(v1, read64(p));
+      v2 = xxh64_round(v2, read64(p + 8));
+      v3 = xxh64_round(v3, read64(p + 16));
+      v4 = xxh64_round(v4, read64(p + 24));
+      p += 32;
+    } while (p <= limit);
+    h = rotl64(v1, 1) + rotl64(v2, 7) + rotl64(v3, 12) + rotl64(v4, 18);
+    h = xxh64_merge_round(h, v1);
+    h = xxh64_merge_round(h, v2);
+    h = xxh64_merge_round(h, v3);
+    h = xxh64_merge_round(h, v4);
+  } else {
+    h = PRIME64_5;
+  }
+
+  h += (uint64_t)len;
+
+  while (p + 8 <= end) {
+    h ^= xxh64_round(0, read64(p));
+    h = rotl64(h, 27) * PRIME64_1 + PRIME64_4;
+    p += 8;
+  }
+  if (p + 4 <= end) {
+    h ^= (uint64_t)read32(p) * PRIME64_1;
+    h = rotl64(h, 23) * PRIME64_2 + PRIME64_3;
+    p += 4;
+  }
+  while (p < end) {
+    h ^= (*p) * PRIME64_5;
+    h = rotl64(h, 11) * PRIME64_1;
+    p++;
+  }
+
+  h ^= h >> 33;
+  h *= PRIME64_2;
+  h ^= h >> 29;
+  h *= PRIME64_3;
+  h ^= h >> 32;
+  return h;
+}
+
+static uint32_t payload_checksum(const void *buf, Py_ssize_t len) {
+  uint64_t h;
+  if (len >= NOGIL_CHECKSUM_SIZE) {
+    Py_BEGIN_ALLOW_THREADS h = xxh64(buf, (size_t)len);
+    Py_END_ALLOW_THREADS
+  } else {
+    h = xxh64(buf, (size_t)len);
+  }
+  return (uint32_t)h;
+}
+
+static PyObject *raise_checksum_error(uint32_t checksum, uint32_t expected) {
+  PyObject *exc =
+      PyObject_CallFunction(checksum_error, "kk", (unsigned long)checksum,
+                            (unsigned long)expected);
+  if (exc != NULL) {
+    PyErr_SetObject((PyObject *)Py_TYPE(exc), exc);
+    Py_DECREF(exc);
+  }
+  return NULL;
+}
+
+/* mirrors frame.check_header */
+static int check_header(long compression, unsigned long bitflags,
+                        unsigned long long size, unsigned long checksum,
+                        unsigned long meta) {
+  if (size == 0) {
+    PyErr_SetString(PyExc_Exception, "Empty body");
+    return -1;
+  }
+  if (size > max_payload_size) {
+    PyErr_SetString(PyExc_Exception, "Bad payload. Size exceeds maximum");
+    return -1;
+  }
+  if (compression > compression_max) {
+    PyErr_SetString(PyExc_Exception, "Invalid compression request");
+    return -1;
+  }
+  if (checksum == 0) {
+    PyErr_SetString(PyExc_Exception, "Empty checksum");
+    return -1;
+  }
+  if (bitflags & ~has_payload_headers) {
+    PyErr_SetString(PyExc_NotImplementedError, "Bitflags not implemented");
+    return -1;
+  }
+  if (meta == 0) {
+    PyErr_SetString(PyExc_Exception, "Empty meta");
+    return -1;
+  }
+  return 0;
+}
+
+static PyObject *speedups_init(PyObject *self, PyObject *args) {
+  PyObject *error;
+  if (!PyArg_ParseTuple(args, "OKlk", &error, &max_payload_size,
+                        &compression_max, &has_payload_headers)) {
+    return NULL;
+  }
+  Py_INCREF(error);
+  Py_XSETREF(checksum_error, error);
+  Py_RETURN_NONE;
+}
+
+static int check_nargs(const char *name, Py_ssize_t nargs,
+                       Py_ssize_t expected) {
+  if (nargs != expected) {
+    PyErr_Format(PyExc_TypeError, "%s() takes exactly %zd arguments (%zd given)",
+                 name, expected, nargs);
+    return -1;
+  }
+  return 0;
+}
+
+/* the hot functions use METH_FASTCALL, argument tuple parsing costs about as
+   much as checksumming a small payload */
+
+static PyObject *speedups_checksum(PyObject *self, PyObject *const *args,
+                                   Py_ssize_t nargs) {
+  Py_buffer view;
+  uint32_t checksum;
+  if (check_nargs("checksum", nargs, 1) < 0 ||
+      PyObject_GetBuffer(args[0], &view, PyBUF_SIMPLE) < 0) {
+    return NULL;
+  }
+  checksum = payload_checksum(view.buf, view.len);
+  PyBuffer_Release(&view);
+  return PyLong_FromUnsignedLong(checksum);
+}
+
+static PyObject *speedups_encode_header(PyObject *self, PyObject *const *args,
+                                        Py_ssize_t nargs) {
+  long compression, bitflags, session_id;
+  unsigned long meta;
+  Py_buffer view;
+  unsigned char *p;
+  PyObject *header;
+  uint32_t checksum;
+
+  if (check_nargs("encode_header", nargs, 5) < 0) {
+    return NULL;
+  }
+  compression = PyLong_AsLong(args[0]);
+  bitflags = PyLong_AsLong(args[1]);
+  session_id = PyLong_AsLong(args[2]);
+  meta = PyLong_AsUnsignedLong(args[4]);
+  if (PyErr_Occurred()) {
+    return NULL;
+  }
+  if (PyObject_GetBuffer(args[3], &view, PyBUF_SIMPLE) < 0) {
+    return NULL;
+  }
+  if ((unsigned long long)view.len > 0xffffffffULL) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_OverflowError, "Payload too large");
+    return NULL;
+  }
+  checksum = payload_checksum(view.buf, view.len);
+  header = PyBytes_FromStringAndSize(NULL, HEADER_SIZE);
+  if (header == NULL) {
+    PyBuffer_Release(&view);
+    return NULL;
+  }
+  p = (unsigned char *)PyBytes_AS_STRING(header);
+  p[0] = (unsigned char)(signed char)compression;
+  p[1] = (unsigned char)bitflags;
+  p[2] = (unsigned char)session_id;
+  p[3] = (unsigned char)(session_id >> 8);
+  write32(p + 4, (uint32_t)view.len);
+  write32(p + 8, checksum);
+  write32(p + 12, (uint32_t)meta);
+  PyBuffer_Release(&view);
+  return header;
+}
+
+/*
+ * parse_frames(buf, pos, verify_limit, large_size, on_frame) -> pos
+ *
+ * Hands every complete frame in buf starting at pos to on_frame and returns
+ * the position of the first frame that was not handled: an incomplete frame,
+ * one carrying payload headers or one of at least large_size bytes. Those
+ * are left to the Python implementation.
+ */
+static PyObject *speedups_parse_frames(PyObject *self, PyObject *const *args,
+                                       Py_ssize_t nargs) {
+  Py_buffer view;
+  Py_ssize_t pos;
+  PyObject *verify_limit_obj, *large_size_obj, *on_frame;
+  unsigned long long verify_limit = ULLONG_MAX, large_size = ULLONG_MAX;
+  const unsigned char *buf;
+
+  if (check_nargs("parse_frames", nargs, 5) < 0) {
+    return NULL;
+  }
+  pos = PyLong_AsSsize_t(args[1]);
+  if (pos == -1 && PyErr_Occurred()) {
+    return NULL;
+  }
+  verify_limit_obj = args[2];
+  large_size_obj = args[3];
+  on_frame = args[4];
+  if (PyObject_GetBuffer(args[0], &view, PyBUF_SIMPLE) < 0) {
+    return NULL;
+  }
+  if (pos < 0 || pos > view.len) {
+    PyErr_SetString(PyExc_ValueError, "Invalid position");
+    goto error;
+  }
+  if (verify_limit_obj != Py_None) {
+    verify_limit = PyLong_AsUnsignedLongLong(verify_limit_obj);
+    if (PyErr_Occurred()) {
+      goto error;
+    }
+  }
+  if (large_size_obj != Py_None) {
+    large_size = PyLong_AsUnsignedLongLong(large_size_obj);
+    if (PyErr_Occurred()) {
+      goto error;
+    }
+  }
+
+  buf = view.buf;
+  while (view.len - pos >= HEADER_SIZE) {
+    const unsigned char *p = buf + pos;
+    long compression = (signed char)p[0];
+    unsigned long bitflags = p[1];
+    unsigned long session_id = read16(p + 2);
+    unsigned long size = read32(p + 4);
+    unsigned long checksum = read32(p + 8);
+    unsigned long meta = read32(p + 12);
+    PyObject *payload, *result;
+
+    if (check_header(compression, bitflags, size, checksum, meta) < 0) {
+      goto error;
+    }
+    if ((bitflags & has_payload_headers) || size >= large_size ||
+        (unsigned long long)(view.len - pos - HEADER_SIZE) < size) {
+      break;
+    }
+    p += HEADER_SIZE;
+    if (size < verify_limit) {
+      uint32_t actual = payload_checksum(p, (Py_ssize_t)size);
+      if (actual != checksum) {
+        raise_checksum_error(actual, (uint32_t)checksum);
+        goto error;
+      }
+    }
+    payload = PyBytes_FromStringAndSize((const char *)p, (Py_ssize_t)size);
+    if (payload == NULL) {
+      goto error;
+    }
+    pos += HEADER_SIZE + (Py_ssize_t)size;
+    result = PyObject_CallFunction(on_frame, "(iikkkk)NO", (int)compression,
+                                   (int)bitflags, session_id, size, checksum,
+                                   meta, payload, Py_None);
+    if (result == NULL) {
+      goto error;
+    }
+    Py_DECREF(result);
+  }
+
+  PyBuffer_Release(&view);
+  return PyLong_FromSsize_t(pos);
+
+error:
+  PyBuffer_Release(&view);
+  return NULL;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"init", speedups_init, METH_VARARGS,
+     "Sets the protocol constants and the checksum error class."},
+    {"checksum", (PyCFunction)(void (*)(void))speedups_checksum, METH_FASTCALL,
+     "Returns the smf checksum of a buffer."},
+    {"encode_header", (PyCFunction)(void (*)(void))speedups_encode_header,
+     METH_FASTCALL, "Checksums a payload and packs its header."},
+    {"parse_frames", (PyCFunction)(void (*)(void))speedups_parse_frames,
+     METH_FASTCALL,
+     "Hands complete frames in a buffer to a callback."},
+    {NULL, NULL, 0, NULL}};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT, "aiosmf._speedups",
+    "C implementation of the smf frame hot path.", -1, speedups_methods};
+
+PyMODINIT_FUNC PyInit__speedups(void) {
+  return PyModule_Create(&speedups_module);
+}
@@ -0,0 +1,73 @@
+__all__ = [
+    "BufferPool",
+]
+
+
+class BufferPool:
+    """
+    Size-classed pool of receive buffers.
+
+    Buffers are bytearrays with power-of-two capacities between min_size and
+    max_size. acquire returns a memoryview of exactly the requested size that
+    must be handed back with release once the caller is done with it. Views
+    derived from a released buffer must not be used afterwards since the
+    memory is reused for later payloads.
+    """
+
+    def __init__(self,
+                 *,
+                 min_size=65536,
+                 max_size=64 * 1024 * 1024,
+                 max_free_per_class=4):
+        if min_size < 1 or max_size < min_size:
+            raise ValueError("Invalid buffer size range")
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_free_per_class = max_free_per_class
+        self._free = {}
+        self._allocations = 0
+        self._reuses = 0
+
+    @property
+    def min_size(self):
+        return self._min_size
+
+    def acquire(self, size):
+        if size > self._max_size:
+            self._allocations += 1
+            return memoryview(bytearray(size))
+        size_class = max(size, self._min_size) - 1
+        size_class = size_class.bit_length()
+        free = self._free.get(size_class)
+        if free:
+            buf = free.pop()
+            self._reuses += 1
+        else:
+            buf = bytearray(1 << size_class)
+            self._allocations += 1
+        return memoryview(buf)[:size]
+
+    def release(self, view):
+        buf = view.obj
+        view.release()
+        capacity = len(buf)
+        if capacity < self._min_size or capacity > self._max_size \
+                or capacity & (capacity - 1):
+            return
+        free = self._free.setdefault(capacity.bit_length() - 1, [])
+        if len(free) < self._max_free_per_class \
+                and not any(b is buf for b in free):
+            free.append(buf)
+
+    def stats(self):
+        free = 0
+        free_bytes = 0
+        for c, buffers in self._free.items():
+            free += len(buffers)
+            free_bytes += (1 << c) * len(buffers)
+        return {
+            "free": free,
+            "free_bytes": free_bytes,
+            "allocations": self._allocations,
+            "reuses": self._reuses,
+        }
@@ -0,0 +1,140 @@
+import asyncio
+import collections
+
+from .util import payload_checksum
+from .server import STATUS_OK
+
+__all__ = [
+    "ResponseCache",
+]
+
+
+def _detach(target, payload):
+    """
+    Returns a reply payload that is safe to hand out more than once. Replies
+    received into pooled buffers are copied and the buffer returned.
+    """
+    if isinstance(payload, memoryview):
+        data = bytes(payload)
+        release = getattr(target, "release", None)
+        if release is not None:
+            release(payload)
+        return data
+    return payload
+
+
+class _Entry:
+    __slots__ = ("payload", "reply", "expires", "size")
+
+    def __init__(self, payload, reply, expires):
+        self.payload = payload
+        self.reply = reply
+        self.expires = expires
+        self.size = len(payload) + len(reply[0])
+
+
+class ResponseCache:
+    """
+    Caches replies of idempotent functions in front of a connection or pool.
+
+    Only functions registered with a TTL are cached, and only their replies
+    with status 200. Entries are keyed by the function id and the payload
+    checksum, and the cached request payload is compared on lookup so that
+    checksum collisions can't return the reply to a different request. The
+    least recently used entries are evicted once the request and reply
+    payloads of all entries exceed max_bytes.
+
+    Calls passing headers bypass the cache since the reply may depend on
+    them.
+
+    Args:
+      target: an SMFConnection or SMFPool.
+      max_bytes: bound on the cached request and reply payload bytes.
+      ttls: dict mapping function id to TTL in seconds.
+    """
+
+    def __init__(self,
+                 target,
+                 *,
+                 max_bytes=64 * 1024 * 1024,
+                 ttls=None,
+                 loop=None):
+        self._target = target
+        self._max_bytes = max_bytes
+        self._ttls = dict(ttls or {})
+        self._loop = loop or asyncio.get_running_loop()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def register(self, func_id, ttl):
+        """Caches replies of func_id for ttl seconds."""
+        if ttl <= 0:
+            raise ValueError("Invalid ttl: must be > 0")
+        self._ttls[func_id] = ttl
+
+    def unregister(self, func_id):
+        self._ttls.pop(func_id, None)
+        self.invalidate(func_id)
+
+    def invalidate(self, func_id=None):
+        """Drops the cached replies of func_id, or of every function."""
+        for key in list(self._entries):
+            if func_id is None or key[0] == func_id:
+                self._remove(key)
+
+    async def call(self, payload, func_id, **kwargs):
+        """
+        Returns the cached reply if there is one. Otherwise invokes the
+        function on the target, accepting the same arguments as
+        SMFConnection.call.
+        """
+        ttl = self._ttls.get(func_id)
+        if ttl is None or kwargs.get("headers"):
+            return await self._target.call(payload, func_id, **kwargs)
+        key = (func_id, payload_checksum(payload))
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires <= self._loop.time():
+                self._expirations += 1
+                self._remove(key)
+            elif entry.payload == payload:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry.reply
+        self._misses += 1
+        reply = await self._target.call(payload, func_id, **kwargs)
+        reply = (_detach(self._target, reply[0]), reply[1])
+        if reply[1] == STATUS_OK:
+            self._insert(key, bytes(payload), reply, ttl)
+        return reply
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def _insert(self, key, payload, reply, ttl):
+        entry = _Entry(payload, reply, self._loop.time() + ttl)
+        if entry.size > self._max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._bytes > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
@@ -0,0 +1,174 @@
+import mmap
+import time
+import random
+import struct
+
+from .frame import HEADER_SIZE, pack_header, unpack_header, chain_header
+from .headers import HAS_PAYLOAD_HEADERS, PayloadHeaders
+
+__all__ = [
+    "Capture",
+    "read_capture",
+]
+
+# A capture log starts with the magic and is followed by records, each a
+# fixed size record header, the frame header (the 16 byte smf header and for
+# requests any payload headers) and the payload as sent on the wire.
+MAGIC = b"SMFCAP1\0"
+
+# direction, connection id, frame header size, payload size, monotonic ns
+_RECORD = struct.Struct("<BxxxIIIQ")
+
+OUTGOING = 0
+INCOMING = 1
+
+
+class Capture:
+    """
+    Appends the frames of sampled calls to a binary capture log.
+
+    A sampled call's request and its replies are captured along with the
+    time they were written or read. Replies are captured without their
+    payload headers. Records are appended through a write buffer, so
+    capturing costs a sampling decision per call plus, for sampled calls, a
+    copy of their frames. Capturing stops once the log reaches max_bytes.
+
+    A capture can be shared by the connections of a pool. Logs are read
+    with read_capture and replayed with python -m aiosmf.replay.
+
+    Args:
+      path: the log file, appended to if it exists.
+      sample_rate: fraction of calls captured.
+      max_bytes: size of the log after which nothing more is captured.
+      buffer_size: size of the write buffer.
+    """
+
+    def __init__(self,
+                 path,
+                 *,
+                 sample_rate=1.0,
+                 max_bytes=None,
+                 buffer_size=1 << 20):
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Invalid sample_rate: must be in (0, 1]")
+        self._file = open(path, "ab", buffering=buffer_size)
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(MAGIC)
+            self._size = len(MAGIC)
+        self._sample_rate = sample_rate
+        self._max_bytes = max_bytes
+        self._connections = 0
+        self.records = 0
+
+    def sample(self):
+        """Returns True if the next call should be captured."""
+        if self._file is None:
+            return False
+        if self._max_bytes is not None and self._size >= self._max_bytes:
+            return False
+        return self._sample_rate >= 1 or random.random() < self._sample_rate
+
+    def connection_id(self):
+        """Returns an id distinguishing the sessions of a connection."""
+        self._connections += 1
+        return self._connections
+
+    def record(self, direction, connection_id, header, payload):
+        if self._file is None:
+            return
+        write = self._file.write
+        write(
+            _RECORD.pack(direction, connection_id, len(header), len(payload),
+                         time.monotonic_ns()))
+        write(header)
+        write(payload)
+        self._size += _RECORD.size + len(header) + len(payload)
+        self.records += 1
+
+    def record_reply(self, connection_id, header, payload):
+        """Records a received frame from its decoded header tuple."""
+        compression, bitflags, session_id, size, checksum, meta = header
+        self.record(
+            INCOMING, connection_id,
+            pack_header(compression, bitflags & ~HAS_PAYLOAD_HEADERS,
+                        session_id, size, checksum, meta), payload)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CaptureRecord:
+    """A frame read from a capture log."""
+
+    __slots__ = ("direction", "connection_id", "timestamp", "header",
+                 "headers", "payload")
+
+    def __init__(self, direction, connection_id, timestamp, header, headers,
+                 payload):
+        self.direction = direction
+        self.connection_id = connection_id
+        # monotonic nanoseconds
+        self.timestamp = timestamp
+        # header tuple describing the payload, as passed to on_frame
+        self.header = header
+        # PayloadHeaders or None
+        self.headers = headers
+        # memoryview into the mapped log
+        self.payload = payload
+
+    @property
+    def session_id(self):
+        return self.header[2]
+
+    @property
+    def meta(self):
+        return self.header[5]
+
+    @property
+    def compression(self):
+        return self.header[0]
+
+
+def read_capture(path):
+    """
+    Memory maps a capture log and yields its records in order.
+
+    Payloads are views into the mapping, which stays open while they are
+    referenced.
+    """
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+    view = memoryview(buf)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise Exception("{} is not an smf capture log".format(path))
+    pos = len(MAGIC)
+    end = len(view)
+    while pos + _RECORD.size <= end:
+        direction, connection_id, header_size, payload_size, timestamp = \
+            _RECORD.unpack_from(view, pos)
+        pos += _RECORD.size
+        if pos + header_size + payload_size > end:
+            # truncated by a crash
+            break
+        header = unpack_header(view, pos)
+        headers = None
+        if header[1] & HAS_PAYLOAD_HEADERS:
+            headers = PayloadHeaders(
+                bytes(view[pos + HEADER_SIZE:pos + header_size]))
+            header = chain_header(header, headers)
+        pos += header_size
+        payload = view[pos:pos + payload_size]
+        pos += payload_size
+        yield CaptureRecord(direction, connection_id, timestamp, header,
+                            headers, payload)
@@ -2,13 +2,25 @@ import socket
 import asyncio
 import collections
 import logging
-import flatbuffers
-import aiosmf.smf.rpc.header
 
-from .util import (parse_address, payload_checksum)
+from .util import (parse_address, unix_path, payload_checksum, payload_hasher,
+                   hasher_checksum, SharedDrain)
+from .frame import (HEADER_SIZE, build_header, unpack_header, chain_header,
+                    check_header, check_payload, ChecksumError)
+from .headers import (HAS_PAYLOAD_HEADERS, DEADLINE_HEADER, STATUS_TIMEOUT,
+                      PayloadHeaders, reusable_builder)
+from .protocol import SMFProtocol
+from .metrics import Metrics
+from .tracing import (STAGE_OUTGOING_FILTERS, STAGE_ENCODE, STAGE_WRITE,
+                      STAGE_READ, STAGE_WAIT, STAGE_VERIFY,
+                      STAGE_INCOMING_FILTERS, STAGE_CALL)
+from .slots import SlotAllocator
+from .lanes import LaneScheduler
+from .capture import OUTGOING
+from .stream import (ReplyStream, STATUS_PARTIAL_CONTENT, STREAM_WINDOW_HEADER,
+                     STREAM_CREDITS_HEADER, STREAM_CONTROL_META, END_OF_STREAM)
 
-from .constants import (COMPRESSION_NONE, COMPRESSION_DISABLED,
-                        COMPRESSION_MAX)
+from .constants import (COMPRESSION_NONE, COMPRESSION_DISABLED)
 
 __all__ = [
     "create_connection",
@@ -17,22 +29,96 @@ __all__ = [
 
 logger = logging.getLogger("smf")
 
+# contexts kept for reuse by a connection
+MAX_FREE_CONTEXTS = 256
+
 
 class _Context:
     """
     Manage RPC send and receive state.
     """
+    __slots__ = ("payload", "meta", "session_id", "compression", "headers",
+                 "checksum")
 
-    def __init__(self, payload, meta, session_id,
-                 compression=COMPRESSION_NONE):
+    def __init__(self,
+                 payload,
+                 meta,
+                 session_id,
+                 compression=COMPRESSION_NONE,
+                 headers=None):
         self.payload = payload
         self.meta = meta
         self.session_id = session_id
         self.compression = compression
+        # outgoing: dict or None, incoming: PayloadHeaders or None
+        self.headers = headers
+        # expected checksum of a received payload whose verification was
+        # deferred so that it can run off the event loop
+        self.checksum = None
+
+    def get_header(self, key, default=None):
+        if self.headers is None:
+            return default
+        return self.headers.get(key, default)
+
+    def set_header(self, key, value):
+        if self.headers is None:
+            self.headers = {}
+        self.headers[key] = value
 
     def apply(self, filters):
+        """
+        Runs filters in order. A filter may return an awaitable, in which case
+        the remaining filters run once it completes and apply returns an
+        awaitable for the whole chain. Returns None if every filter completed
+        synchronously.
+        """
+        for i, f in enumerate(filters):
+            pending = f(self)
+            if pending is not None:
+                return self._apply_async(pending, filters[i + 1:])
+        return None
+
+    async def _apply_async(self, pending, filters):
+        await pending
         for f in filters:
-            f(self)
+            pending = f(self)
+            if pending is not None:
+                await pending
+
+
+class _ContextPool:
+    """
+    Free list of contexts, so that calls don't allocate them. Contexts must
+    only be put back once nothing refers to them anymore.
+    """
+    __slots__ = ("_free", )
+
+    def __init__(self):
+        self._free = []
+
+    def get(self,
+            payload,
+            meta,
+            session_id,
+            compression=COMPRESSION_NONE,
+            headers=None):
+        if not self._free:
+            return _Context(payload, meta, session_id, compression, headers)
+        ctx = self._free.pop()
+        ctx.payload = payload
+        ctx.meta = meta
+        ctx.session_id = session_id
+        ctx.compression = compression
+        ctx.headers = headers
+        ctx.checksum = None
+        return ctx
+
+    def put(self, ctx):
+        if len(self._free) < MAX_FREE_CONTEXTS:
+            ctx.payload = None
+            ctx.headers = None
+            self._free.append(ctx)
 
 
 async def create_connection(address,
@@ -40,15 +126,19 @@ async def create_connection(address,
                             incoming_filters=(),
                             outgoing_filters=(),
                             timeout=None,
-                            loop=None):
+                            use_protocol=False,
+                            loop=None,
+                            **kwargs):
     """Creates an smf connection.
 
     Args:
+      address: host:port, or unix:/path for a unix domain socket.
+      use_protocol: use the low-level asyncio.Protocol transport which parses
+        frames as data arrives instead of awaiting a StreamReader.
+      kwargs: connection options passed through to SMFConnection.
     Returns:
       The new connection.
     """
-    host, port = parse_address(address)
-
     if timeout is not None and (not isinstance(timeout, (int, float)) \
             or timeout <= 0):
         raise ValueError("Invalid timeout: None or > 0")
@@ -56,14 +146,29 @@ async def create_connection(address,
     if loop is None:
         loop = asyncio.get_running_loop()
 
-    reader, writer = await asyncio.wait_for(asyncio.open_connection(host,
-                                                                    port,
-                                                                    loop=loop),
+    path = unix_path(address)
+    if path is not None:
+        if use_protocol:
+            connect = loop.create_unix_connection(
+                lambda: SMFProtocol(loop=loop), path)
+        else:
+            connect = asyncio.open_unix_connection(path, loop=loop)
+    else:
+        host, port = parse_address(address)
+        if use_protocol:
+            connect = loop.create_connection(lambda: SMFProtocol(loop=loop),
+                                             host, port)
+        else:
+            connect = asyncio.open_connection(host, port, loop=loop)
+    reader, writer = await asyncio.wait_for(connect,
                                             timeout=timeout,
                                             loop=loop)
+    if use_protocol:
+        # loop.create_connection returns (transport, protocol)
+        reader = None
 
     sock = writer.transport.get_extra_info("socket")
-    if sock is not None:
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         address = sock.getpeername()
@@ -73,10 +178,51 @@ async def create_connection(address,
                          incoming_filters=incoming_filters,
                          outgoing_filters=outgoing_filters,
                          address=address,
-                         loop=loop)
+                         loop=loop,
+                         **kwargs)
 
 
 class SMFConnection:
+    """
+    An smf client connection.
+
+    When reader is None the writer must be an SMFProtocol which delivers
+    replies to the connection as they are parsed.
+
+    Args:
+      max_in_flight: maximum number of outstanding requests. Calls wait for
+        a free slot once the window is full. Defaults to the full 16-bit
+        session id space.
+      call_timeout: default timeout in seconds for calls that don't pass one.
+      propagate_deadlines: send the remaining time budget of calls that have
+        a timeout to the server in the smf-timeout-ms payload header. Their
+        status 504 replies raise asyncio.TimeoutError.
+      buffer_pool: a BufferPool. Reply payloads of at least pool.min_size
+        bytes are received directly into pooled buffers and returned as a
+        memoryview, which should be handed back with release().
+      executor: a concurrent.futures executor used to checksum payloads of
+        at least offload_size bytes off the event loop.
+      offload_size: payload size from which work is sent to the executor.
+      cork: queue outgoing frames and write them with a single writelines and
+        drain per event loop iteration instead of once per call.
+      cork_max_bytes: flush queued frames immediately once this many bytes
+        are queued.
+      cork_delay: seconds to hold queued frames before flushing. The default
+        of 0 flushes at the end of the current loop iteration.
+      metrics: record call metrics, see metrics(). May be a Metrics instance
+        shared with other connections.
+      hooks: trace hooks called as hook(ctx, stage, t_start, t_end) with the
+        loop time spent in each stage of a call, see aiosmf.tracing.
+      lanes: number of priority lanes. Calls then pass a priority, 0 being
+        the highest, and requests waiting to be written go out by lane, see
+        aiosmf.lanes.LaneScheduler. Can't be combined with cork.
+      lane_weights: per lane weights to share the connection by weighted
+        fair queueing instead of strict priority.
+      lane_max_queued_bytes: bytes that may be queued in each lane but lane
+        0 before its callers wait.
+      capture: an aiosmf.capture.Capture logging the frames of sampled calls.
+    """
+
     def __init__(self,
                  reader,
                  writer,
@@ -84,6 +230,21 @@ class SMFConnection:
                  address,
                  incoming_filters=(),
                  outgoing_filters=(),
+                 max_in_flight=None,
+                 call_timeout=None,
+                 propagate_deadlines=False,
+                 buffer_pool=None,
+                 executor=None,
+                 offload_size=1 << 20,
+                 cork=False,
+                 cork_max_bytes=65536,
+                 cork_delay=0,
+                 metrics=True,
+                 hooks=(),
+                 lanes=None,
+                 lane_weights=None,
+                 lane_max_queued_bytes=1 << 22,
+                 capture=None,
                  loop=None):
         self._reader = reader
         self._writer = writer
@@ -91,34 +252,310 @@ class SMFConnection:
         self._loop = loop or asyncio.get_running_loop()
         self._incoming_filters = incoming_filters
         self._outgoing_filters = outgoing_filters
-        self._session_id = 0
+        self._slots = SlotAllocator(max_in_flight, loop=self._loop)
         self._sessions = {}
+        self._contexts = _ContextPool()
+        self._header_builder = reusable_builder()
+        self._call_timeout = call_timeout
+        self._propagate_deadlines = propagate_deadlines
+        self._buffer_pool = buffer_pool
+        self._executor = executor
+        self._offload_size = offload_size if executor is not None else None
+        self._late_replies = 0
+        self._cork = cork
+        self._cork_max_bytes = cork_max_bytes
+        self._cork_delay = cork_delay
+        self._send_buffer = []
+        self._send_buffer_size = 0
+        self._flush_waiter = None
+        self._flush_handle = None
+        # waiters of flushed frames, drained by a single task
+        self._flushed = []
+        self._flush_task = None
+        self._drainer = SharedDrain(writer, self._loop)
+        if metrics is True:
+            metrics = Metrics()
+        self._metrics = metrics or None
+        self._hooks = tuple(hooks) or None
+        self._capture = capture
+        self._capture_id = None
+        if capture is not None:
+            self._capture_id = capture.connection_id()
+        # sessions of sampled calls
+        self._captured = set()
+        self._lanes = None
+        if lanes is not None:
+            if cork:
+                raise ValueError("Priority lanes can't be combined with cork")
+            self._lanes = LaneScheduler(writer,
+                                        lanes,
+                                        weights=lane_weights,
+                                        max_queued_bytes=lane_max_queued_bytes,
+                                        loop=self._loop)
+        self._read_spans = {}
         self._closed = False
         self._close_state = asyncio.Event()
-        self._reader_task = asyncio.ensure_future(self._read_requests(),
-                                                  loop=self._loop)
-        self._reader_task.add_done_callback(lambda _: self._close_state.set())
+        if reader is None:
+            self._reader_task = None
+            writer.attach(self, buffer_pool, self._offload_size)
+        else:
+            self._reader_task = asyncio.ensure_future(self._read_requests(),
+                                                      loop=self._loop)
+            self._reader_task.add_done_callback(
+                lambda _: self._close_state.set())
 
     def __repr__(self):
         return "<SMFConnection [{}]>".format(self._address)
 
-    async def call(self, payload, func_id):
+    def call(self,
+             payload,
+             func_id,
+             *,
+             timeout=None,
+             headers=None,
+             priority=0):
         """
+        Returns a coroutine resolving to the (payload, meta) reply. Not being
+        a coroutine itself saves a coroutine frame per call in flight.
+
+        Args:
+            payload:
+            func_id:
+            timeout: seconds to wait for the reply, overriding the connection
+                default. Raises asyncio.TimeoutError when exceeded.
+            headers: dict of string headers sent to the server as payload
+                headers.
+            priority: lane of the request if the connection has priority
+                lanes, 0 being the highest. Ignored otherwise.
+        """
+        if timeout is None:
+            timeout = self._call_timeout
+        if timeout is None:
+            return self._call(payload, func_id, headers, None, priority)
+        deadline = None
+        if self._propagate_deadlines:
+            deadline = self._loop.time() + timeout
+        return asyncio.wait_for(self._call(payload, func_id, headers, deadline,
+                                           priority),
+                                timeout,
+                                loop=self._loop)
+
+    async def _call(self, payload, func_id, headers, deadline, priority):
+        if self._closed:
+            raise Exception("{} closed".format(self))
+        start = self._loop.time()
+        call_ctx = self._contexts.get(payload, func_id, None)
+        try:
+            session_id, future_reply = await self._new_session()
+        except BaseException:
+            self._call_failed(call_ctx, start)
+            raise
+        call_ctx.session_id = session_id
+        if headers:
+            call_ctx.headers = dict(headers)
+        if deadline is not None:
+            remaining = max(int((deadline - self._loop.time()) * 1000), 1)
+            call_ctx.set_header(DEADLINE_HEADER, str(remaining))
+        try:
+            header = await self._encode_request(call_ctx)
+        except BaseException:
+            self._end_session(session_id)
+            self._call_failed(call_ctx, start)
+            raise
+        try:
+            await self._send_request(call_ctx, header, priority)
+        except BaseException:
+            # the request may already be on the wire, so its id is only
+            # reused once a late reply arrived
+            self._abandon_session(session_id)
+            self._call_failed(call_ctx, start)
+            raise
+        # the reply is awaited here rather than in _receive_reply so that
+        # calls in flight hold one coroutine frame less
+        t_start = None
+        if self._hooks is not None:
+            t_start = self._loop.time()
+        try:
+            recv_ctx = await future_reply
+        except asyncio.CancelledError:
+            self._abandon_session(session_id)
+            self._call_failed(call_ctx, start)
+            raise
+        except BaseException:
+            self._call_failed(call_ctx, start)
+            raise
+        reply = await self._decode_reply(call_ctx, recv_ctx, start, t_start)
+        if deadline is not None and reply[1] == STATUS_TIMEOUT:
+            # the server gave up on the propagated deadline just before
+            # wait_for would have
+            self.release(reply[0])
+            raise asyncio.TimeoutError()
+        return reply
+
+    async def call_many(self, requests, *, timeout=None, priority=0):
+        """
+        Pipeline a batch of calls.
+
+        All requests are written with a single writelines and drain, unless
+        the in-flight window fills up part way through the batch.
+
+        Args:
+            requests: iterable of (payload, func_id) tuples.
+            timeout: seconds to wait for the whole batch, overriding the
+                connection default.
+            priority: lane of the requests, see call.
+        Returns:
+            A list of (payload, meta) replies in request order.
+        """
+        if timeout is None:
+            timeout = self._call_timeout
+        if timeout is None:
+            return await self._call_many(requests, priority)
+        return await asyncio.wait_for(self._call_many(requests, priority),
+                                      timeout,
+                                      loop=self._loop)
+
+    async def _call_many(self, requests, priority):
+        if self._closed:
+            raise Exception("{} closed".format(self))
+        start = self._loop.time()
+        frames = []
+        unsent = []
+        ctxs = []
+        replies = []
+        try:
+            for payload, func_id in requests:
+                session_id = self._slots.try_acquire()
+                if session_id is None and frames:
+                    # send what we have so that the window can drain
+                    sent, unsent = unsent, []
+                    await self._write_frames(frames, sent, priority)
+                    frames = []
+                session_id, future_reply = await self._new_session(session_id)
+                call_ctx = self._contexts.get(payload, func_id, session_id)
+                unsent.append(call_ctx)
+                ctxs.append(call_ctx)
+                replies.append(future_reply)
+                frames.append(await self._encode_request(call_ctx))
+                frames.append(call_ctx.payload)
+            sent, unsent = unsent, []
+            await self._write_frames(frames, sent, priority)
+        except BaseException:
+            # requests handed to the transport may already be on the wire
+            for call_ctx in ctxs[:len(ctxs) - len(unsent)]:
+                self._abandon_session(call_ctx.session_id)
+            for call_ctx in unsent:
+                self._end_session(call_ctx.session_id)
+            for call_ctx in ctxs:
+                self._call_failed(call_ctx, start)
+            raise
+        return await asyncio.gather(*[
+            self._receive_reply(call_ctx, future_reply, start)
+            for call_ctx, future_reply in zip(ctxs, replies)
+        ])
+
+    async def stream(self,
+                     payload,
+                     func_id,
+                     *,
+                     window=16,
+                     timeout=None,
+                     headers=None,
+                     priority=0):
+        """
+        Invoke a remote function whose handler streams its replies.
+
         Args:
             payload:
             func_id:
+            window: number of replies the server may send ahead of the
+                consumer, bounding the replies buffered for the stream.
+            timeout: seconds to wait for each reply, overriding the
+                connection default. With propagate_deadlines the server is
+                given as long for each reply.
+            headers: dict of string headers sent to the server as payload
+                headers.
+            priority: lane of the request, see call.
+        Returns:
+            A ReplyStream, an async iterator of (payload, meta) replies.
         """
+        if window < 1:
+            raise ValueError("Invalid window: must be >= 1")
         if self._closed:
             raise Exception("{} closed".format(self))
-        session_id, future_reply = self._new_session()
-        call_ctx = _Context(payload, func_id, session_id)
-        await self._send_request(call_ctx)
-        return await self._receive_reply(future_reply)
+        if timeout is None:
+            timeout = self._call_timeout
+        session_id, _ = await self._new_session()
+        ctx = _Context(payload, func_id, session_id)
+        if headers:
+            ctx.headers = dict(headers)
+        ctx.set_header(STREAM_WINDOW_HEADER, str(window))
+        if timeout is not None and self._propagate_deadlines:
+            ctx.set_header(DEADLINE_HEADER, str(max(int(timeout * 1000), 1)))
+        stream = ReplyStream(self, ctx, window, timeout)
+        self._sessions[session_id] = stream
+        try:
+            header = await self._encode_request(ctx)
+        except BaseException:
+            self._end_session(session_id)
+            self._call_failed(ctx, stream._start)
+            raise
+        try:
+            await self._send_frames((header, ctx.payload), priority)
+        except BaseException:
+            # the request was written, the session ends with the server's
+            # final frame
+            stream.close()
+            raise
+        return stream
+
+    def release(self, payload):
+        """
+        Returns a reply payload received into a pooled buffer to the pool.
+        Payloads that were not pooled are ignored.
+        """
+        if self._buffer_pool is not None and isinstance(payload, memoryview):
+            self._buffer_pool.release(payload)
+
+    def slot_stats(self):
+        """Returns session slot occupancy and wait statistics."""
+        stats = self._slots.stats()
+        stats["late_replies"] = self._late_replies
+        return stats
+
+    def lane_stats(self):
+        """
+        Returns the queue depth, sends and send wait in microseconds of every
+        priority lane, or None if the connection has no lanes.
+        """
+        if self._lanes is None:
+            return None
+        return self._lanes.stats()
+
+    def metrics(self):
+        """
+        Returns a snapshot of the call metrics as plain dicts, or None if
+        metrics are disabled. Latencies are in microseconds.
+        """
+        if self._metrics is None:
+            return None
+        snapshot = self._metrics.snapshot()
+        snapshot["in_flight"] = len(self._sessions)
+        return snapshot
+
+    @property
+    def closed(self):
+        """True if the connection was closed or its reader has stopped."""
+        return self._closed or self._close_state.is_set()
 
     def close(self):
         if self._closed:
             return
-        self._reader_task.cancel()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self._flush()
+        if self._lanes is not None:
+            self._lanes.close(Exception("{} closed".format(self)))
         self._writer.close()
         self._closed = True
 
@@ -126,49 +563,257 @@ class SMFConnection:
         self.close()
         await self._close_state.wait()
         await self._writer.wait_closed()
-        for reply_fut in self._sessions.values():
-            reply_fut.set_exception(Exception("Connection closed"))
-
-    def _new_session(self):
-        # uint16_t::max = 65535
-        self._session_id += 1
-        if self._session_id > 65535:
-            self._session_id = 0
-        if self._session_id in self._sessions:
-            raise Exception("no rpc slot available")
+        self._fail_sessions(Exception("Connection closed"))
+
+    async def _new_session(self, session_id=None):
+        if session_id is None:
+            session_id = self._slots.try_acquire()
+            if session_id is None:
+                session_id = await self._slots.acquire()
+        if self.closed:
+            self._slots.release(session_id)
+            raise Exception("{} closed".format(self))
         future_reply = self._loop.create_future()
-        self._sessions[self._session_id] = future_reply
-        return (self._session_id, future_reply)
-
-    async def _send_request(self, ctx):
-        ctx.apply(self._outgoing_filters)
-        header = self._build_header(ctx)
-        self._writer.write(header)
-        self._writer.write(ctx.payload)
-        await self._writer.drain()
-
-    def _build_header(self, ctx):
-        checksum = payload_checksum(ctx.payload)
-        builder = flatbuffers.Builder(20)
-        header = aiosmf.smf.rpc.header.Createheader(builder, ctx.compression,
-                                                    0, ctx.session_id,
-                                                    len(ctx.payload), checksum,
-                                                    ctx.meta)
-        builder.Finish(header)
-        # XXX: the flatbuffers python code doesn't offer a sizeof option for
-        # structs and the serialization also adds a size header into the buffer.
-        # so when integrating an update the codegen make sure that the header is
-        # stripped off and the size is correct.
-        buf = builder.Output()[4:]
-        assert len(buf) == 16
-        return buf
+        self._sessions[session_id] = future_reply
+        return (session_id, future_reply)
+
+    def _end_session(self, session_id):
+        if self._captured:
+            self._captured.discard(session_id)
+        if self._sessions.pop(session_id, None) is not None:
+            self._slots.release(session_id)
+
+    def _abandon_session(self, session_id):
+        if self._captured:
+            self._captured.discard(session_id)
+        if self._sessions.pop(session_id, None) is not None:
+            self._slots.abandon(session_id)
+
+    async def _send_request(self, ctx, header, priority=0):
+        if self._hooks is not None:
+            await self._write_frames((header, ctx.payload), (ctx, ), priority)
+        elif self._lanes is not None:
+            written = self._lanes.send((header, ctx.payload), priority)
+            if written is not None:
+                await asyncio.shield(written)
+        elif self._cork:
+            await asyncio.shield(self._queue_frames((header, ctx.payload)))
+        else:
+            self._writer.write(header)
+            self._writer.write(ctx.payload)
+            await self._drain()
+
+    async def _write_frames(self, frames, ctxs, priority=0):
+        if self._hooks is not None:
+            t_start = self._loop.time()
+        await self._send_frames(frames, priority)
+        if self._hooks is not None:
+            t_end = self._loop.time()
+            for ctx in ctxs:
+                self._trace(ctx, STAGE_WRITE, t_start, t_end)
+
+    async def _send_frames(self, frames, priority):
+        if self._lanes is not None:
+            written = self._lanes.send(frames, priority)
+            if written is not None:
+                await asyncio.shield(written)
+        elif self._cork:
+            await asyncio.shield(self._queue_frames(frames))
+        else:
+            self._writer.writelines(frames)
+            await self._drain()
+
+    def _drain(self):
+        """Waits for the write buffer to drain, see SharedDrain."""
+        return self._drainer.wait()
+
+    def _queue_frames(self, frames):
+        """
+        Queue frames for the next flush and return a future that completes
+        once they have been written and drained.
+        """
+        self._send_buffer.extend(frames)
+        self._send_buffer_size += sum(len(f) for f in frames)
+        waiter = self._flush_waiter
+        if waiter is None:
+            waiter = self._loop.create_future()
+            self._flush_waiter = waiter
+            if self._cork_delay > 0:
+                self._flush_handle = self._loop.call_later(
+                    self._cork_delay, self._flush)
+            else:
+                self._flush_handle = self._loop.call_soon(self._flush)
+        if self._send_buffer_size >= self._cork_max_bytes:
+            self._flush()
+        return waiter
+
+    def _flush(self):
+        waiter = self._flush_waiter
+        if waiter is None:
+            return
+        self._flush_handle.cancel()
+        self._flush_handle = None
+        self._flush_waiter = None
+        frames = self._send_buffer
+        self._send_buffer = []
+        self._send_buffer_size = 0
+        try:
+            self._writer.writelines(frames)
+        except Exception as e:
+            waiter.set_exception(e)
+            return
+        # one drain covers every flush made before it starts
+        self._flushed.append(waiter)
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._drain_flushed(),
+                                                     loop=self._loop)
+
+    async def _drain_flushed(self):
+        try:
+            while self._flushed:
+                waiters = self._flushed
+                self._flushed = []
+                exc = None
+                try:
+                    await self._drain()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    exc = e
+                for waiter in waiters:
+                    if waiter.done():
+                        continue
+                    if exc is None:
+                        waiter.set_result(None)
+                    else:
+                        waiter.set_exception(exc)
+        finally:
+            self._flush_task = None
+            waiters = self._flushed
+            self._flushed = []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(Exception("Flush cancelled"))
+
+    def _send_stream_control(self, session_id, credits):
+        if self.closed:
+            return
+        frames = (build_header(COMPRESSION_NONE, session_id, END_OF_STREAM,
+                               STREAM_CONTROL_META,
+                               {STREAM_CREDITS_HEADER: str(credits)}),
+                  END_OF_STREAM)
+        if self._cork:
+            self._queue_frames(frames)
+        else:
+            self._writer.writelines(frames)
+
+    async def _encode_request(self, ctx):
+        hooks = self._hooks
+        if hooks is not None:
+            t_start = self._loop.time()
+        size = len(ctx.payload)
+        pending = ctx.apply(self._outgoing_filters)
+        if pending is not None:
+            await pending
+        if self._metrics is not None:
+            self._metrics.record_request(ctx.meta, size, len(ctx.payload))
+        if hooks is not None:
+            t_filtered = self._loop.time()
+            self._trace(ctx, STAGE_OUTGOING_FILTERS, t_start, t_filtered)
+        checksum = None
+        if self._offload_size is not None \
+                and len(ctx.payload) >= self._offload_size:
+            checksum = await self._loop.run_in_executor(
+                self._executor, payload_checksum, ctx.payload)
+        header = self._build_header(ctx, checksum)
+        if self._capture is not None and self._capture.sample():
+            self._captured.add(ctx.session_id)
+            self._capture.record(OUTGOING, self._capture_id, header,
+                                 ctx.payload)
+        if hooks is not None:
+            self._trace(ctx, STAGE_ENCODE, t_filtered, self._loop.time())
+        return header
+
+    def _build_header(self, ctx, checksum=None):
+        return build_header(ctx.compression, ctx.session_id, ctx.payload,
+                            ctx.meta, ctx.headers, checksum,
+                            self._header_builder)
+
+    async def _receive_reply(self, ctx, future_reply, start):
+        t_start = None
+        if self._hooks is not None:
+            t_start = self._loop.time()
+        try:
+            recv_ctx = await future_reply
+        except asyncio.CancelledError:
+            self._abandon_session(ctx.session_id)
+            self._call_failed(ctx, start)
+            raise
+        except BaseException:
+            self._call_failed(ctx, start)
+            raise
+        return await self._decode_reply(ctx, recv_ctx, start, t_start)
 
-    async def _receive_reply(self, future_reply):
-        recv_ctx = await future_reply
-        recv_ctx.apply(self._incoming_filters)
-        if recv_ctx.compression != COMPRESSION_NONE:
-            raise Exception("Unexpected reply state")
-        return recv_ctx.payload, recv_ctx.meta
+    async def _decode_reply(self, ctx, recv_ctx, start, t_start):
+        hooks = self._hooks
+        if hooks is not None:
+            t_end = self._loop.time()
+            read_span = self._read_spans.pop(ctx.session_id, None)
+            if read_span is not None:
+                self._trace(ctx, STAGE_READ, *read_span)
+            self._trace(ctx, STAGE_WAIT, t_start, t_end)
+        payload = recv_ctx.payload
+        wire_size = len(payload)
+        try:
+            if recv_ctx.checksum is not None:
+                checksum = await self._loop.run_in_executor(
+                    self._executor, payload_checksum, payload)
+                if recv_ctx.checksum != checksum:
+                    if self._metrics is not None:
+                        self._metrics.checksum_failures += 1
+                    raise ChecksumError(checksum, recv_ctx.checksum)
+                if hooks is not None:
+                    t_start, t_end = t_end, self._loop.time()
+                    self._trace(ctx, STAGE_VERIFY, t_start, t_end)
+            pending = recv_ctx.apply(self._incoming_filters)
+            if pending is not None:
+                await pending
+            if recv_ctx.compression != COMPRESSION_NONE:
+                raise Exception("Unexpected reply state")
+        except BaseException:
+            self._call_failed(ctx, start)
+            self.release(recv_ctx.payload)
+            raise
+        finally:
+            # filters such as decompression replace a pooled payload
+            if recv_ctx.payload is not payload:
+                self.release(payload)
+        end = self._loop.time()
+        if self._metrics is not None:
+            self._metrics.record_reply(ctx.meta, end - start, wire_size,
+                                       len(recv_ctx.payload))
+        if hooks is not None:
+            self._trace(ctx, STAGE_INCOMING_FILTERS, t_end, end)
+            self._trace(ctx, STAGE_CALL, start, end)
+            return recv_ctx.payload, recv_ctx.meta
+        reply = (recv_ctx.payload, recv_ctx.meta)
+        # trace hooks may hold on to contexts, so only reused without them
+        self._contexts.put(recv_ctx)
+        self._contexts.put(ctx)
+        return reply
+
+    def _call_failed(self, ctx, start):
+        if self._metrics is not None:
+            self._metrics.record_error(ctx.meta)
+        if self._hooks is not None:
+            self._trace(ctx, STAGE_CALL, start, self._loop.time())
+
+    def _trace(self, ctx, stage, t_start, t_end):
+        for hook in self._hooks:
+            try:
+                hook(ctx, stage, t_start, t_end)
+            except Exception:
+                logger.exception("Trace hook failed")
 
     async def _read_requests(self):
         exc = None
@@ -187,45 +832,133 @@ class SMFConnection:
                 logger.debug("Reader task handled request")
 
         logger.debug("Reader task finishing")
-        for reply_fut in self._sessions.values():
-            reply_fut.set_exception(exc)
+        self._record_reader_exit(exc)
+        self._fail_sessions(exc)
+
+    def _reader_finished(self, exc):
+        self._record_reader_exit(exc)
+        self._fail_sessions(exc)
+        self._close_state.set()
+
+    def _record_reader_exit(self, exc):
+        if self._metrics is None or self._closed:
+            return
+        self._metrics.reader_exits += 1
+        if isinstance(exc, ChecksumError):
+            self._metrics.checksum_failures += 1
+
+    def _fail_sessions(self, exc):
+        sessions = self._sessions
+        self._sessions = {}
+        for session_id, reply_fut in sessions.items():
+            if not reply_fut.done():
+                reply_fut.set_exception(exc)
+            # wakes callers waiting for a slot, which then see the
+            # connection is closed
+            self._slots.release(session_id)
 
     async def _read_request(self):
         header = await self._read_header()
+        if self._hooks is not None:
+            t_start = self._loop.time()
+        headers = None
+        if header[1] & HAS_PAYLOAD_HEADERS:
+            headers = PayloadHeaders(await self._read_buffer(header))
+            header = chain_header(header, headers)
+            check_header(header)
         payload = await self._read_payload(header)
-        compression = header.Compression()
-        if header.Compression() == COMPRESSION_DISABLED:
+        if self._hooks is None:
+            self._handle_frame(header, payload, headers)
+            return
+        read_span = (t_start, self._loop.time())
+        if self._handle_frame(header, payload, headers) is not None:
+            # reported by the caller, which has the call context
+            self._read_spans[header[2]] = read_span
+
+    def _handle_frame(self, header, payload, headers=None):
+        """Hands a reply to its caller and returns its context, if any."""
+        compression, _, session_id, _, _, meta = header
+        if compression == COMPRESSION_DISABLED:
+            compression = COMPRESSION_NONE
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            self.release(payload)
+            if self._slots.reclaim(session_id):
+                logger.debug("Dropping late reply for session %d", session_id)
+                self._late_replies += 1
+                return None
+            raise Exception("Session {} not found".format(session_id))
+        if self._captured and session_id in self._captured:
+            self._capture.record_reply(self._capture_id, header, payload)
+            if meta != STATUS_PARTIAL_CONTENT:
+                self._captured.discard(session_id)
+        if session.__class__ is ReplyStream:
+            self._handle_stream_frame(session, header, payload, headers)
+            return None
+        self._slots.release(session_id)
+        if session.done():
+            self.release(payload)
+            return None
+        recv_ctx = self._contexts.get(payload, meta, session_id, compression,
+                                      headers)
+        if self._offload_size is not None and header[3] >= self._offload_size \
+                and not isinstance(payload, memoryview):
+            # not verified by the reader, see _read_payload
+            recv_ctx.checksum = header[4]
+        session.set_result(recv_ctx)
+        return recv_ctx
+
+    def _handle_stream_frame(self, stream, header, payload, headers):
+        compression, _, session_id, _, _, meta = header
+        if compression == COMPRESSION_DISABLED:
             compression = COMPRESSION_NONE
-        recv_ctx = _Context(payload, header.Meta(), header.Session(),
-                            compression)
-        session = self._sessions.pop(header.Session(), None)
-        if session is not None:
-            session.set_result(recv_ctx)
+        if meta == STATUS_PARTIAL_CONTENT:
+            self._sessions[session_id] = stream
         else:
-            raise Exception("Session {} not found".format(header.Session()))
+            self._slots.release(session_id)
+        recv_ctx = _Context(payload, meta, session_id, compression, headers)
+        if self._offload_size is not None and header[3] >= self._offload_size \
+                and not isinstance(payload, memoryview):
+            recv_ctx.checksum = header[4]
+        stream.set_result(recv_ctx)
 
     async def _read_header(self):
-        buf = await self._reader.readexactly(16)
-        header = aiosmf.smf.rpc.header.header()
-        header.Init(buf, 0)
-        if header.Size() == 0:
-            raise Exception("Empty body")
-        if header.Size() > flatbuffers.builder.Builder.MAX_BUFFER_SIZE:
-            raise Exception("Bad payload. Size exceeds maximum")
-        if header.Compression() > COMPRESSION_MAX:
-            raise Exception("Invalid compression request")
-        if header.Checksum() <= 0:
-            raise Exception("Empty checksum")
-        if header.Bitflags() != 0:
-            raise NotImplementedError("Bitflags not implemented")
-        if header.Meta() <= 0:
-            raise Exception("Empty meta")
+        buf = await self._reader.readexactly(HEADER_SIZE)
+        header = unpack_header(buf)
+        check_header(header)
         return header
 
     async def _read_payload(self, header):
-        buf = await self._reader.readexactly(header.Size())
-        checksum = payload_checksum(buf)
-        if header.Checksum() == checksum:
-            return buf
-        raise Exception("Payload checksum {} does not match header {}" \
-                .format(checksum, header.Checksum()))
+        if self._buffer_pool is not None \
+                and header[3] >= self._buffer_pool.min_size:
+            return await self._read_pooled_payload(header)
+        if self._offload_size is not None and header[3] >= self._offload_size:
+            # large payloads are verified in the executor by _receive_reply
+            return await self._reader.readexactly(header[3])
+        return await self._read_buffer(header)
+
+    async def _read_buffer(self, header):
+        buf = await self._reader.readexactly(header[3])
+        check_payload(header, buf)
+        return buf
+
+    async def _read_pooled_payload(self, header):
+        view = self._buffer_pool.acquire(header[3])
+        try:
+            hasher = payload_hasher()
+            filled = 0
+            while filled < len(view):
+                chunk = await self._reader.read(len(view) - filled)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(bytes(view[:filled]),
+                                                      len(view))
+                view[filled:filled + len(chunk)] = chunk
+                hasher.update(chunk)
+                filled += len(chunk)
+            checksum = hasher_checksum(hasher)
+            if header[4] != checksum:
+                raise ChecksumError(checksum, header[4])
+        except BaseException:
+            self._buffer_pool.release(view)
+            raise
+        return view
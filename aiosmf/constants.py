@@ -1,6 +1,7 @@
 from aiosmf.smf.rpc.compression_flags import compression_flags
 
 COMPRESSION_ZSTD = compression_flags().zstd
+COMPRESSION_LZ4 = compression_flags().lz4
 COMPRESSION_NONE = compression_flags().none
 COMPRESSION_DISABLED = compression_flags().disabled
 COMPRESSION_MAX = compression_flags().max
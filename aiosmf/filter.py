@@ -1,27 +1,492 @@
+import os
+import time
+import asyncio
 import zstandard as zstd
 
-from .constants import (COMPRESSION_ZSTD, COMPRESSION_NONE)
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
+from .constants import (COMPRESSION_ZSTD, COMPRESSION_LZ4, COMPRESSION_NONE,
+                        COMPRESSION_DISABLED)
+
+
+class ZstdDictionaries:
+    """
+    Zstd dictionaries for per-function compression.
+
+    Dictionaries are selected by the function id (meta) when compressing and
+    by the dictionary id embedded in the zstd frame when decompressing, so the
+    two sides only need to share the same set of dictionaries. Trained
+    dictionaries use the function id as their dictionary id by default.
+    """
 
-class ZstdDecompressionFilter:
     def __init__(self):
+        self._by_meta = {}
+        self._by_id = {}
+
+    def __len__(self):
+        return len(self._by_meta)
+
+    def add(self, meta, dictionary):
+        """Registers a dictionary (ZstdCompressionDict or raw bytes)."""
+        if not isinstance(dictionary, zstd.ZstdCompressionDict):
+            dictionary = zstd.ZstdCompressionDict(dictionary)
+        if dictionary.dict_id() == 0:
+            raise ValueError("Dictionary for meta {} has no id".format(meta))
+        self._by_meta[meta] = dictionary
+        self._by_id[dictionary.dict_id()] = dictionary
+
+    def train(self,
+              meta,
+              samples,
+              *,
+              dict_size=16384,
+              dict_id=None,
+              k=0,
+              d=0,
+              steps=4):
+        """Trains and registers a dictionary from sample payloads.
+
+        Args:
+          meta: function id the dictionary is used for.
+          samples: list of captured payloads (bytes).
+          dict_size: maximum size of the dictionary in bytes.
+          dict_id: id stored in the dictionary. Defaults to meta.
+          k, d: segment and dmer sizes of the COVER algorithm. When 0 they
+            are searched for in steps steps.
+        Returns:
+          The trained dictionary.
+        """
+        if dict_id is None:
+            dict_id = meta
+        # zstandard before 0.15 fails to train without k and d or steps
+        dictionary = zstd.train_dictionary(dict_size,
+                                           list(samples),
+                                           k=k,
+                                           d=d,
+                                           steps=steps,
+                                           dict_id=dict_id)
+        self.add(meta, dictionary)
+        return dictionary
+
+    def for_meta(self, meta):
+        return self._by_meta.get(meta)
+
+    def for_id(self, dict_id):
+        return self._by_id.get(dict_id)
+
+    def save(self, path):
+        """Writes every dictionary to path as <meta>.zdict files."""
+        os.makedirs(path, exist_ok=True)
+        for meta, dictionary in self._by_meta.items():
+            filename = os.path.join(path, "{}.zdict".format(meta))
+            with open(filename, "wb") as f:
+                f.write(dictionary.as_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """Loads dictionaries previously written with save."""
+        dictionaries = cls()
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext != ".zdict":
+                continue
+            with open(os.path.join(path, filename), "rb") as f:
+                dictionaries.add(int(name), f.read())
+        return dictionaries
+
+
+async def _offload(ctx, executor, fn, compression):
+    # zstandard and lz4 release the GIL while (de)compressing
+    loop = asyncio.get_running_loop()
+    ctx.payload = await loop.run_in_executor(executor, fn, ctx.payload)
+    ctx.compression = compression
+
+
+class ZstdDecompressionFilter:
+    """
+    Args:
+      dictionaries: ZstdDictionaries for payloads compressed with one.
+      executor: a concurrent.futures executor for payloads of at least
+        offload_size bytes. The filter then returns an awaitable.
+    """
+
+    def __init__(self,
+                 *,
+                 dictionaries=None,
+                 executor=None,
+                 offload_size=1 << 20):
         self._compress_ctx = zstd.ZstdDecompressor()
+        self._dictionaries = dictionaries
+        self._dict_ctxs = {}
+        self._executor = executor
+        self._offload_size = offload_size
 
     def __call__(self, ctx):
         if ctx.compression == COMPRESSION_ZSTD:
-            ctx.payload = self._compress_ctx.decompress(ctx.payload)
+            if self._executor is not None \
+                    and len(ctx.payload) >= self._offload_size:
+                # decompression contexts are not thread safe
+                dictionary = self._dictionary(ctx.payload)
+                if dictionary is None:
+                    decompressor = zstd.ZstdDecompressor()
+                else:
+                    decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+                fn = decompressor.decompress
+                return _offload(ctx, self._executor, fn, COMPRESSION_NONE)
+            ctx.payload = self._context(ctx.payload).decompress(ctx.payload)
             ctx.compression = COMPRESSION_NONE
 
+    def _dictionary(self, payload):
+        if self._dictionaries is None:
+            return None
+        dict_id = zstd.get_frame_parameters(payload).dict_id
+        if dict_id == 0:
+            return None
+        dictionary = self._dictionaries.for_id(dict_id)
+        if dictionary is None:
+            raise Exception("Unknown zstd dictionary {}".format(dict_id))
+        return dictionary
+
+    def _context(self, payload):
+        dictionary = self._dictionary(payload)
+        if dictionary is None:
+            return self._compress_ctx
+        dict_id = dictionary.dict_id()
+        cached = self._dict_ctxs.get(dict_id)
+        if cached is None or cached[0] is not dictionary:
+            cached = (dictionary, zstd.ZstdDecompressor(dict_data=dictionary))
+            self._dict_ctxs[dict_id] = cached
+        return cached[1]
+
 
 class ZstdCompressionFilter:
-    def __init__(self, min_compression_size, *, strategy=zstd.STRATEGY_FAST):
+    """
+    Args:
+      min_compression_size: smallest payload that is compressed.
+      dictionaries: ZstdDictionaries used for functions that have one.
+      min_dict_compression_size: smallest payload that is compressed with a
+        dictionary.
+      executor: a concurrent.futures executor for payloads of at least
+        offload_size bytes. The filter then returns an awaitable.
+    """
+
+    def __init__(self,
+                 min_compression_size,
+                 *,
+                 strategy=zstd.STRATEGY_FAST,
+                 dictionaries=None,
+                 min_dict_compression_size=32,
+                 executor=None,
+                 offload_size=1 << 20):
         self._min_compression_size = min_compression_size
-        self._params = zstd.CompressionParameters(strategy=strategy)
+        self._params = zstd.ZstdCompressionParameters(strategy=strategy)
         self._compress_ctx = zstd.ZstdCompressor(
             compression_params=self._params)
+        self._dictionaries = dictionaries
+        self._min_dict_compression_size = min_dict_compression_size
+        # explicit compression parameters default to not writing the
+        # dictionary id, which the receiver needs to select the dictionary.
+        self._dict_params = zstd.ZstdCompressionParameters(strategy=strategy,
+                                                           write_dict_id=1)
+        self._dict_ctxs = {}
+        self._executor = executor
+        self._offload_size = offload_size
+
+    def __call__(self, ctx):
+        if ctx.compression != COMPRESSION_NONE:
+            return
+        dictionary = None
+        if self._dictionaries is not None:
+            dictionary = self._dictionaries.for_meta(ctx.meta)
+        if dictionary is not None:
+            min_size = self._min_dict_compression_size
+        else:
+            min_size = self._min_compression_size
+        if len(ctx.payload) < min_size:
+            return
+        if self._executor is not None \
+                and len(ctx.payload) >= self._offload_size:
+            # compression contexts are not thread safe
+            if dictionary is None:
+                cctx = zstd.ZstdCompressor(compression_params=self._params)
+            else:
+                cctx = zstd.ZstdCompressor(
+                    dict_data=dictionary, compression_params=self._dict_params)
+            return _offload(ctx, self._executor, cctx.compress,
+                            COMPRESSION_ZSTD)
+        if dictionary is None:
+            cctx = self._compress_ctx
+        else:
+            cctx = self._dict_context(ctx.meta, dictionary)
+        ctx.payload = cctx.compress(ctx.payload)
+        ctx.compression = COMPRESSION_ZSTD
+
+    def _dict_context(self, meta, dictionary):
+        cached = self._dict_ctxs.get(meta)
+        if cached is None or cached[0] is not dictionary:
+            cctx = zstd.ZstdCompressor(dict_data=dictionary,
+                                       compression_params=self._dict_params)
+            cached = (dictionary, cctx)
+            self._dict_ctxs[meta] = cached
+        return cached[1]
+
+
+def _require_lz4():
+    if lz4 is None:
+        raise ImportError("lz4 compression requires the lz4 package")
+
+
+# lz4 payloads are a single lz4 block prefixed with the uncompressed size as a
+# little-endian uint32 (the lz4.block store_size format).
+
+
+class Lz4DecompressionFilter:
+    """
+    Args:
+      executor: a concurrent.futures executor for payloads of at least
+        offload_size bytes. The filter then returns an awaitable.
+    """
+
+    def __init__(self, *, executor=None, offload_size=1 << 20):
+        _require_lz4()
+        self._executor = executor
+        self._offload_size = offload_size
 
     def __call__(self, ctx):
-        if ctx.compression != COMPRESSION_NONE and \
+        if ctx.compression == COMPRESSION_LZ4:
+            if self._executor is not None \
+                    and len(ctx.payload) >= self._offload_size:
+                return _offload(ctx, self._executor, lz4.block.decompress,
+                                COMPRESSION_NONE)
+            ctx.payload = lz4.block.decompress(ctx.payload)
+            ctx.compression = COMPRESSION_NONE
+
+
+class Lz4CompressionFilter:
+    """
+    Args:
+      min_compression_size: smallest payload that is compressed.
+      acceleration: lz4 fast mode acceleration, trading ratio for speed.
+      executor: a concurrent.futures executor for payloads of at least
+        offload_size bytes. The filter then returns an awaitable.
+    """
+
+    def __init__(self,
+                 min_compression_size,
+                 *,
+                 acceleration=1,
+                 executor=None,
+                 offload_size=1 << 20):
+        _require_lz4()
+        self._min_compression_size = min_compression_size
+        self._acceleration = acceleration
+        self._executor = executor
+        self._offload_size = offload_size
+
+    def __call__(self, ctx):
+        if ctx.compression == COMPRESSION_NONE and \
                 len(ctx.payload) >= self._min_compression_size:
-            ctx.payload = self._compress_ctx.compress(ctx.payload)
-            ctx.compression = COMPRESSION_ZSTD
+            if self._executor is not None \
+                    and len(ctx.payload) >= self._offload_size:
+                return _offload(ctx, self._executor, self._compress,
+                                COMPRESSION_LZ4)
+            ctx.payload = self._compress(ctx.payload)
+            ctx.compression = COMPRESSION_LZ4
+
+    def _compress(self, payload):
+        return lz4.block.compress(payload,
+                                  mode="fast",
+                                  acceleration=self._acceleration)
+
+
+class _Candidate:
+    __slots__ = ("name", "compression", "level", "compress", "ratio",
+                 "seconds_per_byte")
+
+    def __init__(self, name, compression, level, compress):
+        self.name = name
+        self.compression = compression
+        self.level = level
+        self.compress = compress
+        self.ratio = None
+        self.seconds_per_byte = None
+
+    def sample(self, size, compressed_size, seconds, weight):
+        ratio = size / max(compressed_size, 1)
+        seconds_per_byte = seconds / size
+        if self.ratio is None:
+            self.ratio = ratio
+            self.seconds_per_byte = seconds_per_byte
+        else:
+            self.ratio += weight * (ratio - self.ratio)
+            self.seconds_per_byte += weight * (seconds_per_byte -
+                                               self.seconds_per_byte)
+
+
+class _Policy:
+    __slots__ = ("candidates", "choice", "calls", "probes", "until_probe",
+                 "bytes_in", "bytes_out")
+
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self.choice = None
+        self.calls = 0
+        self.probes = 0
+        self.until_probe = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class AdaptiveCompressionFilter:
+    """
+    Outgoing filter that picks the codec and level per function.
+
+    Every probe_interval payloads of a function (and for its first warmup
+    payloads) all candidate codecs are run on the payload and their ratio and
+    compression time are sampled. Other payloads are compressed with the
+    candidate that minimizes the estimated cost of sending a byte: the CPU
+    time spent compressing it plus the time to transmit the compressed byte
+    at bandwidth bytes/s. Functions whose payloads don't compress (already
+    compressed blobs) therefore settle on no compression.
+
+    Payloads that already carry a compression flag, including
+    COMPRESSION_DISABLED, are left untouched. Functions passed to disable
+    are always sent with COMPRESSION_DISABLED.
+
+    The receiving side needs the zstd and (if installed) lz4 decompression
+    filters.
+
+    Args:
+      min_compression_size: smallest payload that is considered.
+      levels: zstd levels to choose from.
+      use_lz4: consider lz4, if the lz4 package is installed.
+      bandwidth: expected link bandwidth in bytes/s.
+      min_ratio: smallest average ratio for which compression is used.
+      probe_interval: payloads between two probes of a function.
+      warmup: payloads of a function that are probed before it settles.
+    """
+
+    def __init__(self,
+                 min_compression_size=64,
+                 *,
+                 levels=(1, 3),
+                 use_lz4=True,
+                 bandwidth=125000000,
+                 min_ratio=1.1,
+                 probe_interval=256,
+                 warmup=3):
+        if probe_interval < 1:
+            raise ValueError("Invalid probe_interval: must be >= 1")
+        self._min_compression_size = min_compression_size
+        self._codecs = [("zstd:{}".format(level), COMPRESSION_ZSTD, level,
+                         zstd.ZstdCompressor(level=level).compress)
+                        for level in levels]
+        if use_lz4 and lz4 is not None:
+            self._codecs.append(
+                ("lz4", COMPRESSION_LZ4, None, lz4.block.compress))
+        self._bandwidth = bandwidth
+        self._min_ratio = min_ratio
+        self._probe_interval = probe_interval
+        self._warmup = warmup
+        self._policies = {}
+        self._disabled = set()
+
+    def disable(self, meta):
+        """Never compresses payloads of meta and flags them as such."""
+        self._disabled.add(meta)
+
+    def enable(self, meta):
+        self._disabled.discard(meta)
+
+    def __call__(self, ctx):
+        if ctx.compression != COMPRESSION_NONE:
+            return
+        if ctx.meta in self._disabled:
+            ctx.compression = COMPRESSION_DISABLED
+            return
+        size = len(ctx.payload)
+        if size < self._min_compression_size:
+            return
+        policy = self._policies.get(ctx.meta)
+        if policy is None:
+            policy = _Policy([_Candidate(*codec) for codec in self._codecs])
+            self._policies[ctx.meta] = policy
+        policy.calls += 1
+        policy.bytes_in += size
+        if policy.until_probe <= 0:
+            payload, compression = self._probe(policy, ctx.payload)
+        else:
+            policy.until_probe -= 1
+            payload, compression = ctx.payload, COMPRESSION_NONE
+            candidate = policy.choice
+            if candidate is not None:
+                start = time.perf_counter()
+                compressed = candidate.compress(payload)
+                candidate.sample(size, len(compressed),
+                                 time.perf_counter() - start, 0.05)
+                if len(compressed) < size:
+                    payload, compression = compressed, candidate.compression
+        policy.bytes_out += len(payload)
+        ctx.payload = payload
+        ctx.compression = compression
+
+    def _probe(self, policy, payload):
+        size = len(payload)
+        best = None
+        for candidate in policy.candidates:
+            start = time.perf_counter()
+            compressed = candidate.compress(payload)
+            candidate.sample(size, len(compressed),
+                             time.perf_counter() - start, 0.5)
+            if best is None or len(compressed) < len(best[0]):
+                best = (compressed, candidate.compression)
+        policy.probes += 1
+        policy.choice = self._choose(policy)
+        if policy.probes < self._warmup:
+            policy.until_probe = 0
+        else:
+            policy.until_probe = self._probe_interval - 1
+        if best is None or len(best[0]) >= size:
+            return payload, COMPRESSION_NONE
+        # the work is done, so send the smallest encoding
+        return best
+
+    def _choose(self, policy):
+        choice = None
+        # cost of sending a byte uncompressed
+        cost = 1 / self._bandwidth
+        for candidate in policy.candidates:
+            if candidate.ratio < self._min_ratio:
+                continue
+            candidate_cost = candidate.seconds_per_byte + 1 / (
+                candidate.ratio * self._bandwidth)
+            if candidate_cost < cost:
+                choice, cost = candidate, candidate_cost
+        return choice
+
+    def stats(self):
+        """Returns the current decision and samples for every function."""
+        stats = {}
+        for meta, policy in self._policies.items():
+            choice = policy.choice
+            stats[meta] = {
+                "codec": "none" if choice is None else choice.name,
+                "level": None if choice is None else choice.level,
+                "calls": policy.calls,
+                "probes": policy.probes,
+                "bytes_in": policy.bytes_in,
+                "bytes_out": policy.bytes_out,
+                "candidates": {
+                    candidate.name: {
+                        "ratio": candidate.ratio,
+                        "seconds_per_byte": candidate.seconds_per_byte,
+                    }
+                    for candidate in policy.candidates
+                },
+            }
+        for meta in self._disabled:
+            stats.setdefault(meta, {})["codec"] = "disabled"
+        return stats
@@ -0,0 +1,218 @@
+import struct
+import flatbuffers
+
+from .util import (payload_checksum, payload_hasher, hasher_checksum,
+                   _speedups)
+from .headers import (HAS_PAYLOAD_HEADERS, PayloadHeaders,
+                      encode_payload_headers)
+
+from .constants import (COMPRESSION_NONE, COMPRESSION_MAX)
+
+__all__ = [
+    "HEADER_SIZE",
+    "ChecksumError",
+    "FrameReader",
+    "build_header",
+    "chain_header",
+    "check_header",
+    "check_payload",
+    "pack_header",
+    "unpack_header",
+]
+
+# Wire layout of the smf rpc header (see aiosmf/smf/rpc/header.py):
+#
+#   [ int8(compression) + uint8(bitflags) + uint16(session) +
+#     uint32(size) + uint32(checksum) + uint32(meta) ]
+#
+# The flatbuffers struct is little-endian and naturally aligned so it has no
+# padding, which makes it byte-for-byte identical to this precompiled struct.
+_HEADER = struct.Struct("<bBHIII")
+HEADER_SIZE = _HEADER.size
+
+pack_header = _HEADER.pack
+unpack_header = _HEADER.unpack_from
+
+_MAX_PAYLOAD_SIZE = flatbuffers.builder.Builder.MAX_BUFFER_SIZE
+
+
+class ChecksumError(Exception):
+    """Raised when a payload does not match the checksum in its header."""
+
+    def __init__(self, checksum, expected):
+        super().__init__("Payload checksum {} does not match header {}".format(
+            checksum, expected))
+
+
+def check_header(header):
+    """Validates a decoded header tuple.
+
+    Raises an exception if the header describes a frame that cannot be
+    handled.
+    """
+    compression, bitflags, _, size, checksum, meta = header
+    if size == 0:
+        raise Exception("Empty body")
+    if size > _MAX_PAYLOAD_SIZE:
+        raise Exception("Bad payload. Size exceeds maximum")
+    if compression > COMPRESSION_MAX:
+        raise Exception("Invalid compression request")
+    if checksum <= 0:
+        raise Exception("Empty checksum")
+    if bitflags & ~HAS_PAYLOAD_HEADERS:
+        raise NotImplementedError("Bitflags not implemented")
+    if meta <= 0:
+        raise Exception("Empty meta")
+
+
+if _speedups is not None:
+    # the C implementation mirrors check_header, check_payload and
+    # build_header for frames without payload headers
+    _speedups.init(ChecksumError, _MAX_PAYLOAD_SIZE, COMPRESSION_MAX,
+                   HAS_PAYLOAD_HEADERS)
+
+
+def chain_header(header, headers):
+    """
+    Returns the header describing the payload chained after a payload headers
+    buffer.
+    """
+    return (headers.compression, header[1], header[2], headers.size,
+            headers.checksum, header[5])
+
+
+def build_header(compression,
+                 session_id,
+                 payload,
+                 meta,
+                 headers=None,
+                 checksum=None,
+                 builder=None):
+    """
+    Encodes the header, and payload headers if any, for a payload. Payload
+    headers are encoded with builder if given, see reusable_builder.
+    """
+    if checksum is None:
+        if not headers and _speedups is not None:
+            return _speedups.encode_header(compression, 0, session_id, payload,
+                                           meta)
+        checksum = payload_checksum(payload)
+    if not headers:
+        return pack_header(compression, 0, session_id, len(payload), checksum,
+                           meta)
+    buf = encode_payload_headers(headers, len(payload), checksum, compression,
+                                 builder)
+    return pack_header(COMPRESSION_NONE, HAS_PAYLOAD_HEADERS, session_id,
+                       len(buf), payload_checksum(buf), meta) + buf
+
+
+def check_payload(header, payload):
+    checksum = payload_checksum(payload)
+    if header[4] != checksum:
+        raise ChecksumError(checksum, header[4])
+
+
+class FrameReader:
+    """
+    Incrementally splits a byte stream into smf frames.
+
+    Received data is appended to a single reusable buffer and each complete
+    frame is passed to a callback as a decoded header tuple, the payload and
+    the payload headers (None unless the frame carries them).
+
+    With a buffer pool, payloads of at least pool.min_size bytes are instead
+    copied straight into a pooled buffer as they arrive and checksummed
+    incrementally. Such payloads are passed as a memoryview that the receiver
+    must release back to the pool.
+
+    Other payloads of at least verify_limit bytes are passed on without
+    verifying their checksum, leaving that to the receiver.
+    """
+
+    def __init__(self, pool=None, verify_limit=None):
+        self._buf = bytearray()
+        self._header = None
+        self._headers = None
+        self._pool = pool
+        self._large_size = pool.min_size if pool is not None else None
+        self._large = None
+        self._verify_limit = verify_limit
+
+    def feed(self, data, on_frame):
+        while data:
+            if self._large is None:
+                data = self._feed(data, on_frame)
+            else:
+                data = self._feed_large(data, on_frame)
+
+    def _feed(self, data, on_frame):
+        buf = self._buf
+        buf += data
+        end = len(buf)
+        pos = 0
+        header = self._header
+        headers = self._headers
+        try:
+            while True:
+                if header is None:
+                    if headers is None and _speedups is not None:
+                        pos = _speedups.parse_frames(buf, pos,
+                                                     self._verify_limit,
+                                                     self._large_size,
+                                                     on_frame)
+                    if end - pos < HEADER_SIZE:
+                        break
+                    header = unpack_header(buf, pos)
+                    check_header(header)
+                    pos += HEADER_SIZE
+                size = header[3]
+                if self._large_size is not None and size >= self._large_size \
+                        and (headers is not None
+                             or not header[1] & HAS_PAYLOAD_HEADERS):
+                    self._large = (header, headers, self._pool.acquire(size),
+                                   payload_hasher(), 0)
+                    header = None
+                    headers = None
+                    rest = bytes(buf[pos:end])
+                    pos = end
+                    return rest
+                stop = pos + size
+                if stop > end:
+                    break
+                payload = bytes(buf[pos:stop])
+                pos = stop
+                if headers is None and header[1] & HAS_PAYLOAD_HEADERS:
+                    check_payload(header, payload)
+                    headers = PayloadHeaders(payload)
+                    header = chain_header(header, headers)
+                    check_header(header)
+                    continue
+                if self._verify_limit is None or size < self._verify_limit:
+                    check_payload(header, payload)
+                on_frame(header, payload, headers)
+                header = None
+                headers = None
+        finally:
+            self._header = header
+            self._headers = headers
+            if pos:
+                del buf[:pos]
+        return None
+
+    def _feed_large(self, data, on_frame):
+        header, headers, view, hasher, filled = self._large
+        n = min(len(data), len(view) - filled)
+        chunk = memoryview(data)[:n]
+        view[filled:filled + n] = chunk
+        hasher.update(chunk)
+        filled += n
+        if filled < len(view):
+            self._large = (header, headers, view, hasher, filled)
+            return None
+        self._large = None
+        checksum = hasher_checksum(hasher)
+        if header[4] != checksum:
+            self._pool.release(view)
+            raise ChecksumError(checksum, header[4])
+        on_frame(header, view, headers)
+        return data[n:]
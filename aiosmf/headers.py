@@ -0,0 +1,138 @@
+import flatbuffers
+
+from aiosmf.smf.rpc.header_bit_flags import header_bit_flags
+from aiosmf.smf.rpc.payload_headers import (
+    payload_headers, payload_headersStart, payload_headersAddDynamicHeaders,
+    payload_headersStartDynamicHeadersVector, payload_headersAddSize,
+    payload_headersAddChecksum, payload_headersAddCompression,
+    payload_headersEnd)
+from aiosmf.smf.rpc.dynamic_header import (dynamic_headerStart,
+                                           dynamic_headerAddKey,
+                                           dynamic_headerAddValue,
+                                           dynamic_headerEnd)
+
+__all__ = [
+    "DEADLINE_HEADER",
+    "HAS_PAYLOAD_HEADERS",
+    "STATUS_TIMEOUT",
+    "PayloadHeaders",
+    "encode_payload_headers",
+    "reusable_builder",
+]
+
+HAS_PAYLOAD_HEADERS = header_bit_flags.has_payload_headers
+
+# remaining time budget of a request in milliseconds
+DEADLINE_HEADER = "smf-timeout-ms"
+
+# status of the reply to a request whose deadline passed on the server
+STATUS_TIMEOUT = 504
+
+# Frames with the has_payload_headers bit set chain two buffers: the rpc
+# header describes a payload_headers flatbuffer, which in turn carries the
+# size, checksum and compression of the actual payload that follows it.
+
+
+def _encode(s):
+    if isinstance(s, str):
+        return s.encode("utf-8")
+    return bytes(s)
+
+
+def reusable_builder():
+    """
+    Returns a flatbuffers builder for encode_payload_headers to reuse, or None
+    if the installed flatbuffers can't clear one.
+    """
+    if not hasattr(flatbuffers.Builder, "Clear"):
+        return None
+    return flatbuffers.Builder(256)
+
+
+def encode_payload_headers(headers, size, checksum, compression, builder=None):
+    """Serializes a dict of headers along with the chained payload fields.
+
+    Dynamic headers are sorted by key so that receivers can binary search. A
+    builder from reusable_builder is cleared and reused instead of allocating
+    a new one.
+    """
+    items = sorted((_encode(k), _encode(v)) for k, v in headers.items())
+    if builder is None:
+        builder = flatbuffers.Builder(64 +
+                                      sum(len(k) + len(v) for k, v in items))
+    else:
+        builder.Clear()
+    offsets = []
+    for key, value in items:
+        key = builder.CreateString(key)
+        value = builder.CreateString(value)
+        dynamic_headerStart(builder)
+        dynamic_headerAddKey(builder, key)
+        dynamic_headerAddValue(builder, value)
+        offsets.append(dynamic_headerEnd(builder))
+    payload_headersStartDynamicHeadersVector(builder, len(offsets))
+    for offset in reversed(offsets):
+        builder.PrependUOffsetTRelative(offset)
+    vector = builder.EndVector(len(offsets))
+    payload_headersStart(builder)
+    payload_headersAddDynamicHeaders(builder, vector)
+    payload_headersAddSize(builder, size)
+    payload_headersAddChecksum(builder, checksum)
+    payload_headersAddCompression(builder, compression)
+    builder.Finish(payload_headersEnd(builder))
+    return builder.Output()
+
+
+class PayloadHeaders:
+    """
+    Read-only view of received payload headers.
+
+    Lookups binary search the sorted dynamic header vector in place.
+    """
+    __slots__ = ("_headers", )
+
+    def __init__(self, buf):
+        self._headers = payload_headers.GetRootAspayload_headers(buf, 0)
+
+    def __len__(self):
+        return self._headers.DynamicHeadersLength()
+
+    def __contains__(self, key):
+        return self._find(_encode(key)) is not None
+
+    @property
+    def size(self):
+        return self._headers.Size()
+
+    @property
+    def checksum(self):
+        return self._headers.Checksum()
+
+    @property
+    def compression(self):
+        return self._headers.Compression()
+
+    def get(self, key, default=None):
+        header = self._find(_encode(key))
+        if header is None:
+            return default
+        return header.Value().decode("utf-8")
+
+    def items(self):
+        for i in range(len(self)):
+            header = self._headers.DynamicHeaders(i)
+            yield header.Key().decode("utf-8"), header.Value().decode("utf-8")
+
+    def _find(self, key):
+        lo, hi = 0, self._headers.DynamicHeadersLength()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            header = self._headers.DynamicHeaders(mid)
+            k = header.Key()
+            if k == key:
+                return header
+            if k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
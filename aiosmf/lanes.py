@@ -0,0 +1,210 @@
+import asyncio
+import collections
+
+from .metrics import Histogram
+
+__all__ = [
+    "LaneScheduler",
+]
+
+# bytes a lane of weight 1 may send per weighted round
+QUANTUM = 16384
+
+
+class _Lane:
+    __slots__ = ("queue", "queued_bytes", "deficit", "waiters", "sent",
+                 "sent_bytes", "wait")
+
+    def __init__(self):
+        # (frames, size, enqueue time, future)
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.deficit = 0
+        self.waiters = collections.deque()
+        self.sent = 0
+        self.sent_bytes = 0
+        self.wait = Histogram()
+
+
+class LaneScheduler:
+    """
+    Orders the requests written to a connection by priority lane.
+
+    Lane 0 has the highest priority. Frames are only moved into the
+    transport while its write buffer is below the high water mark, so that
+    at most that many bytes of lower priority are ever queued ahead of a
+    frame. Beyond that frames wait in their lane, and whenever the transport
+    drains the next frame is taken from the highest priority lane that has
+    one, or with weights by deficit round robin over bytes sent.
+
+    Senders on lanes other than 0 wait while their lane holds more than
+    max_queued_bytes, which bounds the memory of bulk traffic.
+
+    Args:
+      writer: the StreamWriter or SMFProtocol of the connection.
+      lanes: number of priority lanes.
+      weights: per lane weights for weighted fair scheduling instead of
+        strict priority.
+      max_queued_bytes: bound on the bytes queued in each lane but lane 0.
+    """
+
+    def __init__(self,
+                 writer,
+                 lanes,
+                 *,
+                 weights=None,
+                 max_queued_bytes=1 << 22,
+                 loop=None):
+        if lanes < 1:
+            raise ValueError("Invalid lanes: must be >= 1")
+        if weights is not None:
+            if len(weights) != lanes or min(weights) <= 0:
+                raise ValueError(
+                    "Invalid weights: need one weight > 0 per lane")
+            self._quanta = [w * QUANTUM for w in weights]
+        else:
+            self._quanta = None
+        self._writer = writer
+        self._lanes = [_Lane() for _ in range(lanes)]
+        self._max_queued_bytes = max_queued_bytes
+        self._loop = loop or asyncio.get_running_loop()
+        self._queued = 0
+        self._current = 0
+        self._task = None
+        self._exc = None
+
+    def send(self, frames, priority):
+        """
+        Writes frames, or queues them in a lane. Returns None if they were
+        written, otherwise a future that completes once they are.
+        """
+        if not 0 <= priority < len(self._lanes):
+            raise ValueError("Invalid priority: must be in [0, {})".format(
+                len(self._lanes)))
+        if self._exc is not None:
+            raise self._exc
+        lane = self._lanes[priority]
+        size = sum(len(f) for f in frames)
+        if priority and lane.queued_bytes \
+                and lane.queued_bytes + size > self._max_queued_bytes:
+            waiter = self._enqueue_when_space(lane, frames, size)
+            return asyncio.ensure_future(waiter, loop=self._loop)
+        if not self._queued and not self._congested():
+            self._writer.writelines(frames)
+            lane.sent += 1
+            lane.sent_bytes += size
+            lane.wait.record(0)
+            return None
+        return self._enqueue(lane, frames, size)
+
+    def close(self, exc):
+        """Fails queued frames and stops writing."""
+        if self._exc is None:
+            self._exc = exc
+        if self._task is not None:
+            self._task.cancel()
+        self._fail(exc)
+
+    def stats(self):
+        """Returns the queue depth, sends and send wait of every lane."""
+        return [{
+            "queued": len(lane.queue),
+            "queued_bytes": lane.queued_bytes,
+            "sent": lane.sent,
+            "sent_bytes": lane.sent_bytes,
+            "wait_us": lane.wait.snapshot(),
+        } for lane in self._lanes]
+
+    def _congested(self):
+        # transports pause writing above the high water mark, which is when
+        # drain blocks
+        transport = self._writer.transport
+        return transport.get_write_buffer_size() \
+            > transport.get_write_buffer_limits()[1]
+
+    async def _enqueue_when_space(self, lane, frames, size):
+        while lane.queued_bytes \
+                and lane.queued_bytes + size > self._max_queued_bytes:
+            waiter = self._loop.create_future()
+            lane.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in lane.waiters:
+                    lane.waiters.remove(waiter)
+        await self._enqueue(lane, frames, size)
+
+    def _enqueue(self, lane, frames, size):
+        future = self._loop.create_future()
+        lane.queue.append((frames, size, self._loop.time(), future))
+        lane.queued_bytes += size
+        self._queued += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(), loop=self._loop)
+        return future
+
+    def _wake(self, lane):
+        # every waiter checks again whether its frames fit
+        waiters = lane.waiters
+        lane.waiters = collections.deque()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _run(self):
+        try:
+            while self._queued:
+                while self._queued and not self._congested():
+                    lane = self._next_lane()
+                    frames, size, queued_at, future = lane.queue.popleft()
+                    lane.queued_bytes -= size
+                    lane.deficit -= size
+                    self._queued -= 1
+                    self._writer.writelines(frames)
+                    lane.sent += 1
+                    lane.sent_bytes += size
+                    lane.wait.record((self._loop.time() - queued_at) * 1000000)
+                    if not future.done():
+                        future.set_result(None)
+                    if lane.waiters:
+                        self._wake(lane)
+                await self._writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self._exc = e
+            self._fail(e)
+        finally:
+            self._task = None
+
+    def _next_lane(self):
+        lanes = self._lanes
+        if self._quanta is None:
+            for lane in lanes:
+                if lane.queue:
+                    return lane
+        # deficit round robin: a lane sends while its deficit covers the
+        # next frame, then the next lane gets its quantum
+        while True:
+            lane = lanes[self._current]
+            if lane.queue and lane.deficit >= lane.queue[0][1]:
+                return lane
+            if not lane.queue:
+                lane.deficit = 0
+            self._current = (self._current + 1) % len(lanes)
+            lane = lanes[self._current]
+            if lane.queue:
+                lane.deficit += self._quanta[self._current]
+
+    def _fail(self, exc):
+        for lane in self._lanes:
+            for _, _, _, future in lane.queue:
+                if not future.done():
+                    future.set_exception(exc)
+            lane.queue.clear()
+            lane.queued_bytes = 0
+            for waiter in lane.waiters:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            lane.waiters.clear()
+        self._queued = 0
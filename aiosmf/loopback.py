@@ -0,0 +1,184 @@
+import asyncio
+import logging
+
+from .server import (SMFServer, _ServerProtocol)
+from .protocol import SMFProtocol
+from .connection import SMFConnection
+
+__all__ = [
+    "create_loopback_connection",
+]
+
+logger = logging.getLogger("smf")
+
+LOOPBACK_ADDRESS = "loopback"
+
+
+async def create_loopback_connection(server,
+                                     *,
+                                     incoming_filters=(),
+                                     outgoing_filters=(),
+                                     loop=None,
+                                     **kwargs):
+    """Creates an smf connection to a server in the same event loop.
+
+    The connection and the server exchange frames through an in-memory
+    transport pair instead of a socket, so requests still go through the
+    complete client and server stack: filters, framing and checksums.
+
+    Args:
+      server: an SMFServer, which doesn't need to be listening, or a dict of
+        handlers to serve with a new one.
+      kwargs: connection options passed through to SMFConnection.
+    Returns:
+      The new connection.
+    """
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    if not isinstance(server, SMFServer):
+        server = SMFServer(server, loop=loop)
+    protocol = SMFProtocol(loop=loop)
+    server_protocol = _ServerProtocol(server)
+    transport, server_transport = _LoopbackTransport.pair(
+        loop, protocol, server_protocol)
+    protocol.connection_made(transport)
+    server_protocol.connection_made(server_transport)
+    return SMFConnection(None,
+                         protocol,
+                         incoming_filters=incoming_filters,
+                         outgoing_filters=outgoing_filters,
+                         address=LOOPBACK_ADDRESS,
+                         loop=loop,
+                         **kwargs)
+
+
+class _LoopbackTransport(asyncio.Transport):
+    """
+    One end of an in-memory transport pair.
+
+    Written data is delivered to the peer protocol from a later loop callback,
+    like data arriving from a socket. Writers are paused once more than the
+    high water mark of data is waiting for a peer that paused reading.
+    """
+
+    def __init__(self, loop, protocol, high_water=65536):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._peer = None
+        self._pending = []
+        self._pending_size = 0
+        self._scheduled = False
+        self._reading_paused = False
+        self._writing_paused = False
+        self._high_water = high_water
+        self._low_water = high_water // 4
+        self._closing = False
+        self._lost = False
+
+    @classmethod
+    def pair(cls, loop, protocol, peer_protocol):
+        transport = cls(loop, protocol)
+        peer = cls(loop, peer_protocol)
+        transport._peer = peer
+        peer._peer = transport
+        return transport, peer
+
+    def get_extra_info(self, name, default=None):
+        if name in ("peername", "sockname"):
+            return LOOPBACK_ADDRESS
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_reading(self):
+        return not self._reading_paused
+
+    def pause_reading(self):
+        self._reading_paused = True
+
+    def resume_reading(self):
+        if self._reading_paused:
+            self._reading_paused = False
+            self._peer._schedule()
+
+    def get_write_buffer_size(self):
+        return self._pending_size
+
+    def get_write_buffer_limits(self):
+        return (self._low_water, self._high_water)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 65536 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high_water = high
+        self._low_water = low
+
+    def can_write_eof(self):
+        return False
+
+    def write(self, data):
+        if self._closing:
+            return
+        if not data:
+            return
+        self._pending.append(bytes(data))
+        self._pending_size += len(data)
+        self._schedule()
+        if not self._writing_paused and self._pending_size > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        self.write(b"".join(list_of_data))
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        # pending data is still delivered to the peer
+        self._schedule()
+        self._peer.close()
+
+    def abort(self):
+        self._pending = []
+        self._pending_size = 0
+        self.close()
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._deliver)
+
+    def _deliver(self):
+        self._scheduled = False
+        peer = self._peer
+        if peer._lost:
+            self._pending = []
+            self._pending_size = 0
+        if self._pending:
+            if peer._reading_paused and not self._closing:
+                return
+            data = b"".join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            try:
+                peer._protocol.data_received(data)
+            except Exception:
+                logger.exception("Loopback protocol received exception")
+                self.abort()
+            if self._writing_paused and self._pending_size <= self._low_water:
+                self._writing_paused = False
+                self._protocol.resume_writing()
+        if self._closing and not self._pending and not self._lost:
+            self._lost = True
+            self._protocol.connection_lost(None)
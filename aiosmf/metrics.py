@@ -0,0 +1,221 @@
+import math
+
+__all__ = [
+    "Histogram",
+    "Metrics",
+    "prometheus_text",
+]
+
+
+class Histogram:
+    """
+    Fixed-memory histogram of non-negative integers.
+
+    As in HdrHistogram every power of two range is split into 2**precision
+    linear sub-buckets, so values are kept with a relative error below
+    2**-precision in constant memory and recording is O(1). Values above
+    2**max_bits - 1 fall into the last bucket.
+    """
+
+    def __init__(self, *, precision=4, max_bits=40):
+        if not 0 < precision < max_bits:
+            raise ValueError("Invalid precision: must be in [1, max_bits)")
+        self._precision = precision
+        self._sub_buckets = 1 << precision
+        self._max_value = (1 << max_bits) - 1
+        self._counts = [0] * ((max_bits - precision + 1) << precision)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        self._counts[self._index(min(value, self._max_value))] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Returns the value below which a fraction q of values fall."""
+        if not self.count:
+            return 0
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min or 0,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+        }
+
+    def _index(self, value):
+        bits = value.bit_length()
+        if bits <= self._precision:
+            return value
+        shift = bits - self._precision - 1
+        return ((shift + 1) << self._precision) + (
+            value >> shift) - self._sub_buckets
+
+    def _highest(self, index):
+        tier = index >> self._precision
+        if tier == 0:
+            return index
+        top = (index & (self._sub_buckets - 1)) + self._sub_buckets
+        return ((top + 1) << (tier - 1)) - 1
+
+
+class _FunctionMetrics:
+    __slots__ = ("calls", "errors", "latency", "request_bytes",
+                 "request_wire_bytes", "reply_wire_bytes", "reply_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        # microseconds
+        self.latency = Histogram()
+        self.request_bytes = 0
+        self.request_wire_bytes = 0
+        self.reply_wire_bytes = 0
+        self.reply_bytes = 0
+
+    def snapshot(self):
+        request_ratio = _ratio(self.request_bytes, self.request_wire_bytes)
+        reply_ratio = _ratio(self.reply_bytes, self.reply_wire_bytes)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency_us": self.latency.snapshot(),
+            "request_bytes": self.request_bytes,
+            "request_wire_bytes": self.request_wire_bytes,
+            "request_compression_ratio": request_ratio,
+            "reply_wire_bytes": self.reply_wire_bytes,
+            "reply_bytes": self.reply_bytes,
+            "reply_compression_ratio": reply_ratio,
+        }
+
+
+def _ratio(size, wire_size):
+    if not wire_size:
+        return None
+    return size / wire_size
+
+
+class Metrics:
+    """
+    Call metrics of one or more connections.
+
+    Byte counts are kept before (request_bytes, reply_bytes) and after
+    (wire) the filters, so their ratio is the achieved compression ratio.
+    Failed calls, including timed out and cancelled ones, count as errors and
+    are not recorded in the latency histogram.
+    """
+
+    def __init__(self):
+        self._functions = {}
+        self.checksum_failures = 0
+        self.reader_exits = 0
+
+    def function(self, func_id):
+        metrics = self._functions.get(func_id)
+        if metrics is None:
+            metrics = _FunctionMetrics()
+            self._functions[func_id] = metrics
+        return metrics
+
+    def record_request(self, func_id, size, wire_size):
+        metrics = self.function(func_id)
+        metrics.request_bytes += size
+        metrics.request_wire_bytes += wire_size
+
+    def record_reply(self, func_id, seconds, wire_size, size):
+        metrics = self.function(func_id)
+        metrics.calls += 1
+        metrics.latency.record(seconds * 1000000)
+        metrics.reply_wire_bytes += wire_size
+        metrics.reply_bytes += size
+
+    def record_error(self, func_id):
+        metrics = self.function(func_id)
+        metrics.calls += 1
+        metrics.errors += 1
+
+    def snapshot(self):
+        """Returns the metrics as plain dicts."""
+        return {
+            "checksum_failures": self.checksum_failures,
+            "reader_exits": self.reader_exits,
+            "functions": {
+                func_id: metrics.snapshot()
+                for func_id, metrics in self._functions.items()
+            },
+        }
+
+
+_GAUGES = ("in_flight", "connections")
+_QUANTILES = (
+    ("0.5", "p50"),
+    ("0.9", "p90"),
+    ("0.99", "p99"),
+    ("0.999", "p999"),
+)
+
+
+def prometheus_text(snapshot, *, prefix="smf"):
+    """Formats a connection or pool metrics snapshot in the Prometheus text
+    exposition format.
+
+    Latencies are exported as summaries in seconds.
+    """
+    lines = []
+
+    def metric(name, kind, samples):
+        name = "{}_{}".format(prefix, name)
+        lines.append("# TYPE {} {}".format(name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                labels = "{{{}}}".format(",".join('{}="{}"'.format(k, v)
+                                                  for k, v in labels))
+            lines.append("{}{}{} {}".format(name, suffix, labels or "", value))
+
+    for key in sorted(snapshot):
+        value = snapshot[key]
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            kind = "gauge" if key in _GAUGES else "counter"
+            if kind == "counter":
+                key += "_total"
+            metric(key, kind, [("", (), value)])
+    functions = sorted(snapshot.get("functions", {}).items())
+    for key in ("calls", "errors", "request_bytes", "request_wire_bytes",
+                "reply_wire_bytes", "reply_bytes"):
+        metric(key + "_total", "counter",
+               [("", (("func_id", func_id), ), stats[key])
+                for func_id, stats in functions])
+    samples = []
+    for func_id, stats in functions:
+        latency = stats["latency_us"]
+        for q, key in _QUANTILES:
+            samples.append(("", (("func_id", func_id), ("quantile", q)),
+                            latency[key] / 1000000))
+        samples.append(
+            ("_sum", (("func_id", func_id), ), latency["sum"] / 1000000))
+        samples.append(("_count", (("func_id", func_id), ), latency["count"]))
+    metric("call_latency_seconds", "summary", samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+
+from .connection import create_connection
+from .metrics import Metrics
+
+__all__ = [
+    "create_pool",
+    "SMFPool",
+]
+
+logger = logging.getLogger("smf")
+
+
+async def create_pool(addresses,
+                      *,
+                      size_per_host=1,
+                      max_size_per_host=None,
+                      grow_threshold=64,
+                      maintenance_interval=1.0,
+                      loop=None,
+                      **kwargs):
+    """Creates a pool of smf connections to one or more endpoints.
+
+    Args:
+      addresses: a host:port string or a list of them.
+      size_per_host: number of connections kept open to each endpoint.
+      max_size_per_host: upper bound the pool may grow to under load. Defaults
+        to size_per_host (no growth).
+      grow_threshold: average number of outstanding requests per connection
+        above which a new connection is added to an endpoint.
+      maintenance_interval: seconds between health and sizing checks.
+      kwargs: passed through to create_connection.
+    Returns:
+      The new pool.
+    """
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    if not addresses:
+        raise ValueError("At least one address is required")
+    if size_per_host < 1:
+        raise ValueError("Invalid size_per_host: must be >= 1")
+    if max_size_per_host is None:
+        max_size_per_host = size_per_host
+    if max_size_per_host < size_per_host:
+        raise ValueError("Invalid max_size_per_host: must be >= size_per_host")
+
+    if loop is None:
+        loop = asyncio.get_running_loop()
+
+    pool = SMFPool(addresses,
+                   size_per_host=size_per_host,
+                   max_size_per_host=max_size_per_host,
+                   grow_threshold=grow_threshold,
+                   maintenance_interval=maintenance_interval,
+                   loop=loop,
+                   **kwargs)
+    try:
+        await pool._fill()
+    except BaseException:
+        pool.close()
+        await pool.wait_closed()
+        raise
+    pool._start()
+    return pool
+
+
+class SMFPool:
+    """
+    A set of connections spread over one or more endpoints.
+
+    Each call is routed to the live connection with the fewest outstanding
+    requests. A background task replaces dead connections and grows or
+    shrinks the number of connections per endpoint with load. Unless metrics
+    are disabled, the connections record into a single Metrics instance that
+    outlives them.
+    """
+
+    def __init__(self,
+                 addresses,
+                 *,
+                 size_per_host,
+                 max_size_per_host,
+                 grow_threshold,
+                 maintenance_interval,
+                 loop=None,
+                 **kwargs):
+        self._addresses = list(addresses)
+        self._size_per_host = size_per_host
+        self._max_size_per_host = max_size_per_host
+        self._grow_threshold = grow_threshold
+        self._maintenance_interval = maintenance_interval
+        self._loop = loop or asyncio.get_running_loop()
+        metrics = kwargs.get("metrics", True)
+        if metrics is True:
+            metrics = kwargs["metrics"] = Metrics()
+        self._metrics = metrics or None
+        self._replacements = 0
+        self._connect_kwargs = kwargs
+        self._endpoints = {address: [] for address in self._addresses}
+        self._connections = []
+        self._closing = set()
+        self._closed = False
+        self._maintenance_task = None
+
+    def __repr__(self):
+        return "<SMFPool {}>".format(self._addresses)
+
+    @property
+    def connections(self):
+        """The live connections currently in the pool."""
+        return list(self._connections)
+
+    async def call(self, payload, func_id, **kwargs):
+        """
+        Invoke a remote function on the least loaded connection. Accepts the
+        same arguments as SMFConnection.call.
+        """
+        if self._closed:
+            raise Exception("{} closed".format(self))
+        conn = None
+        least = None
+        for c in self._connections:
+            if c.closed:
+                continue
+            n = len(c._sessions)
+            if least is None or n < least:
+                conn, least = c, n
+                if n == 0:
+                    break
+        if conn is None:
+            raise Exception("{} has no live connections".format(self))
+        return await conn.call(payload, func_id, **kwargs)
+
+    def metrics(self):
+        """
+        Returns a snapshot of the call metrics of all connections, or None if
+        metrics are disabled. See SMFConnection.metrics.
+        """
+        if self._metrics is None:
+            return None
+        snapshot = self._metrics.snapshot()
+        snapshot["in_flight"] = sum(
+            len(c._sessions) for c in self._connections)
+        snapshot["connections"] = len(self._connections)
+        snapshot["replacements"] = self._replacements
+        return snapshot
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        for conns in self._endpoints.values():
+            for conn in conns:
+                self._retire(conn)
+            conns.clear()
+        self._connections = []
+
+    async def wait_closed(self):
+        self.close()
+        if self._maintenance_task is not None:
+            try:
+                await self._maintenance_task
+            except asyncio.CancelledError:
+                pass
+        while self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def _start(self):
+        self._maintenance_task = asyncio.ensure_future(self._maintain(),
+                                                       loop=self._loop)
+
+    def _retire(self, conn):
+        # closes a connection once its outstanding requests have drained
+        task = asyncio.ensure_future(self._close_connection(conn),
+                                     loop=self._loop)
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close_connection(self, conn):
+        while conn._sessions and not conn.closed:
+            await asyncio.sleep(self._maintenance_interval)
+        conn.close()
+        await conn.wait_closed()
+
+    async def _connect(self, address):
+        conn = await create_connection(address,
+                                       loop=self._loop,
+                                       **self._connect_kwargs)
+        if self._closed:
+            self._retire(conn)
+        else:
+            self._endpoints[address].append(conn)
+            self._connections.append(conn)
+        return conn
+
+    async def _fill(self):
+        connects = []
+        for address, conns in self._endpoints.items():
+            for _ in range(self._size_per_host - len(conns)):
+                connects.append(self._connect(address))
+        if not connects:
+            return
+        results = await asyncio.gather(*connects, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        for e in errors:
+            logger.warning("Pool connection failed: %s", e)
+        if not self._connections and errors:
+            raise errors[0]
+
+    def _resize(self):
+        grows = []
+        for address, conns in self._endpoints.items():
+            for conn in [c for c in conns if c.closed]:
+                logger.debug("Replacing dead connection %s", conn)
+                self._replacements += 1
+                conns.remove(conn)
+                self._connections.remove(conn)
+                self._retire(conn)
+            if not conns:
+                continue
+            in_flight = sum(len(c._sessions) for c in conns)
+            if in_flight >= self._grow_threshold * len(conns) \
+                    and len(conns) < self._max_size_per_host:
+                grows.append(address)
+            elif len(conns) > self._size_per_host \
+                    and in_flight * 2 < self._grow_threshold * (len(conns) - 1):
+                idle = min(conns, key=lambda c: len(c._sessions))
+                conns.remove(idle)
+                self._connections.remove(idle)
+                self._retire(idle)
+        return grows
+
+    async def _maintain(self):
+        while not self._closed:
+            await asyncio.sleep(self._maintenance_interval)
+            try:
+                grows = self._resize()
+                await self._fill()
+                if grows:
+                    await asyncio.gather(
+                        *[self._connect(address) for address in grows])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Pool maintenance failed")
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+from .frame import FrameReader
+
+__all__ = [
+    "SMFProtocol",
+]
+
+logger = logging.getLogger("smf")
+
+
+class SMFProtocol(asyncio.Protocol):
+    """
+    Low-level asyncio transport for smf connections.
+
+    Frames are parsed directly in data_received and handed to the owning
+    connection without a coroutine hop per frame. The protocol also provides
+    the subset of the StreamWriter interface used by SMFConnection.
+    """
+
+    def __init__(self, *, loop=None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._transport = None
+        self._connection = None
+        self._frames = FrameReader()
+        self._paused = False
+        self._drain_waiter = None
+        self._exception = None
+        self._closed = self._loop.create_future()
+
+    @property
+    def transport(self):
+        return self._transport
+
+    def attach(self, connection, pool=None, verify_limit=None):
+        self._connection = connection
+        self._frames = FrameReader(pool, verify_limit)
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        try:
+            self._frames.feed(data, self._connection._handle_frame)
+        except Exception as e:
+            logger.exception("Protocol received exception")
+            self._exception = e
+            self._transport.close()
+
+    def connection_lost(self, exc):
+        logger.debug("Protocol connection lost")
+        if exc is None:
+            exc = self._exception or Exception("Connection closed")
+        self._wake_drain_waiter(exc)
+        if not self._closed.done():
+            self._closed.set_result(None)
+        if self._connection is not None:
+            self._connection._reader_finished(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain_waiter(None)
+
+    def _wake_drain_waiter(self, exc):
+        waiter = self._drain_waiter
+        if waiter is None:
+            return
+        self._drain_waiter = None
+        if not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writelines(self, data):
+        self._transport.writelines(data)
+
+    async def drain(self):
+        if self._transport.is_closing():
+            # yield so that connection_lost gets a chance to run
+            await asyncio.sleep(0)
+            if self._closed.done():
+                raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+        if self._drain_waiter is None or self._drain_waiter.done():
+            self._drain_waiter = self._loop.create_future()
+        # shared by every drain, which a cancelled caller must not cancel
+        await asyncio.shield(self._drain_waiter)
+
+    def get_extra_info(self, name, default=None):
+        return self._transport.get_extra_info(name, default)
+
+    def close(self):
+        self._transport.close()
+
+    async def wait_closed(self):
+        await self._closed
@@ -0,0 +1,258 @@
+"""
+Replays the requests of a capture log against a server.
+
+    python -m aiosmf.replay capture.log --target 127.0.0.1:20776 --rate max
+
+Requests are sent at their captured pace (--rate original), sped up by a
+factor (--rate 4) or as fast as --concurrency allows (--rate max), over
+--connections pipelined connections. Replies are compared with the captured
+ones by status and by checksum of their decompressed payload. Streaming
+calls are not replayed.
+"""
+import sys
+import json
+import asyncio
+import argparse
+
+from .pool import create_pool
+from .util import payload_checksum
+from .metrics import Histogram
+from .headers import DEADLINE_HEADER
+from .stream import STREAM_WINDOW_HEADER, STATUS_PARTIAL_CONTENT
+from .capture import OUTGOING, read_capture
+from .connection import _Context
+from . import filter as filters
+
+from .constants import COMPRESSION_NONE, COMPRESSION_DISABLED
+
+
+class _Request:
+    __slots__ = ("timestamp", "meta", "payload", "headers", "reply_meta",
+                 "reply_checksum")
+
+    def __init__(self, timestamp, meta, payload, headers):
+        self.timestamp = timestamp
+        self.meta = meta
+        self.payload = payload
+        self.headers = headers
+        # the captured reply, if any
+        self.reply_meta = None
+        self.reply_checksum = None
+
+
+def _decompress(decompressors, record):
+    compression = record.compression
+    if compression == COMPRESSION_DISABLED:
+        compression = COMPRESSION_NONE
+    ctx = _Context(bytes(record.payload), record.meta, record.session_id,
+                   compression)
+    ctx.apply(decompressors)
+    if ctx.compression != COMPRESSION_NONE:
+        raise Exception("Unsupported compression {}".format(ctx.compression))
+    return ctx.payload
+
+
+def _decompressors():
+    decompressors = [filters.ZstdDecompressionFilter()]
+    if filters.lz4 is not None:
+        decompressors.append(filters.Lz4DecompressionFilter())
+    return decompressors
+
+
+def load_requests(path):
+    """
+    Reads the requests of a capture log and pairs them with their captured
+    replies.
+
+    Returns:
+      A tuple of the requests in capture order and the number of streaming
+      calls skipped.
+    """
+    decompressors = _decompressors()
+    requests = []
+    # (connection id, session id) -> request awaiting its reply
+    pending = {}
+    skipped = 0
+    for record in read_capture(path):
+        key = (record.connection_id, record.session_id)
+        if record.direction == OUTGOING:
+            headers = None
+            if record.headers is not None:
+                headers = dict(record.headers.items())
+                if STREAM_WINDOW_HEADER in headers:
+                    skipped += 1
+                    pending.pop(key, None)
+                    continue
+                # deadlines are set again from --timeout
+                headers.pop(DEADLINE_HEADER, None)
+            request = _Request(record.timestamp, record.meta,
+                               _decompress(decompressors, record), headers
+                               or None)
+            requests.append(request)
+            pending[key] = request
+        else:
+            request = pending.pop(key, None)
+            if request is None or record.meta == STATUS_PARTIAL_CONTENT:
+                continue
+            request.reply_meta = record.meta
+            request.reply_checksum = payload_checksum(
+                _decompress(decompressors, record))
+    return requests, skipped
+
+
+class Replay:
+    """
+    Sends captured requests and collects the latency and outcome of their
+    replies.
+
+    Args:
+      target: the pool or connection to send the requests to.
+      rate: "original", "max" or a factor by which the captured pace is
+        sped up.
+      concurrency: bound on the requests in flight.
+      timeout: seconds to wait for each reply.
+    """
+
+    def __init__(self,
+                 target,
+                 *,
+                 rate="original",
+                 concurrency=256,
+                 timeout=None,
+                 loop=None):
+        if rate == "original":
+            self._scale = 1.0
+        elif rate == "max":
+            self._scale = None
+        else:
+            self._scale = float(rate)
+            if self._scale <= 0:
+                raise ValueError("Invalid rate: must be > 0")
+        if concurrency < 1:
+            raise ValueError("Invalid concurrency: must be >= 1")
+        self._target = target
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._loop = loop or asyncio.get_running_loop()
+        self.latency = Histogram()
+        # how late requests were sent relative to their schedule
+        self.lag = Histogram()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.status_mismatches = 0
+        self.checksum_mismatches = 0
+        self.duration = 0
+
+    async def run(self, requests):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        tasks = set()
+        start = self._loop.time()
+        first = requests[0].timestamp if requests else 0
+        for request in requests:
+            if self._scale is not None:
+                due = start + (request.timestamp - first) / 1e9 / self._scale
+                delay = due - self._loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay, loop=self._loop)
+                self.lag.record((self._loop.time() - due) * 1000000)
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self._send(request, semaphore),
+                                         loop=self._loop)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, loop=self._loop)
+        self.duration = self._loop.time() - start
+
+    async def _send(self, request, semaphore):
+        start = self._loop.time()
+        try:
+            payload, meta = await self._target.call(request.payload,
+                                                    request.meta,
+                                                    timeout=self._timeout,
+                                                    headers=request.headers)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        except Exception:
+            self.errors += 1
+            return
+        finally:
+            semaphore.release()
+            self.calls += 1
+        self.latency.record((self._loop.time() - start) * 1000000)
+        if request.reply_meta is None:
+            return
+        if meta != request.reply_meta:
+            self.status_mismatches += 1
+        elif payload_checksum(payload) != request.reply_checksum:
+            self.checksum_mismatches += 1
+
+    def report(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "status_mismatches": self.status_mismatches,
+            "checksum_mismatches": self.checksum_mismatches,
+            "duration": self.duration,
+            "rate": self.calls / self.duration if self.duration else 0,
+            "latency_us": self.latency.snapshot(),
+            "lag_us": self.lag.snapshot(),
+        }
+
+
+async def _main(args):
+    requests, skipped = load_requests(args.log)
+    pool = await create_pool(args.target,
+                             size_per_host=args.connections,
+                             incoming_filters=_decompressors())
+    try:
+        replay = Replay(pool,
+                        rate=args.rate,
+                        concurrency=args.concurrency,
+                        timeout=args.timeout)
+        await replay.run(requests)
+    finally:
+        await pool.wait_closed()
+    report = replay.report()
+    report["skipped_streams"] = skipped
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = " ".join("{}={}".format(k, round(v, 1))
+                             for k, v in value.items())
+        print("{:<20} {}".format(key, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m aiosmf.replay",
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("log", help="capture log to replay")
+    parser.add_argument("--target",
+                        required=True,
+                        help="host:port or unix:/path of the server")
+    parser.add_argument("--rate",
+                        default="original",
+                        help="original, max or a speed-up factor")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="print the report as json")
+    args = parser.parse_args(argv)
+    if args.rate not in ("original", "max"):
+        try:
+            float(args.rate)
+        except ValueError:
+            parser.error("Invalid rate: {}".format(args.rate))
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import asyncio
+
+from .metrics import Histogram
+
+__all__ = [
+    "Replicas",
+]
+
+
+class Replicas:
+    """
+    Calls over a set of connections to replicas serving the same functions.
+
+    hedged_call sends a request to the least loaded replica and, if no reply
+    arrived within the hedge delay, the same request to a second replica.
+    The first reply wins and the other call is cancelled. The hedge delay
+    tracks the hedge_quantile of recent call latencies, so only the slowest
+    calls are hedged, and no hedges are sent until min_samples latencies were
+    recorded. At most a hedge_budget fraction of calls is hedged.
+
+    scatter sends a request to every replica and returns once k of them
+    replied.
+
+    Args:
+      connections: the SMFConnections, one per replica.
+      hedge_quantile: latency quantile used as the hedge delay.
+      min_hedge_delay: lower bound on the hedge delay in seconds.
+      max_hedge_delay: upper bound on the hedge delay in seconds.
+      hedge_budget: maximum fraction of calls that are hedged.
+      window: number of latencies after which older ones are forgotten.
+      min_samples: latencies recorded between hedge delay updates.
+    """
+
+    def __init__(self,
+                 connections,
+                 *,
+                 hedge_quantile=0.95,
+                 min_hedge_delay=0.001,
+                 max_hedge_delay=1.0,
+                 hedge_budget=0.1,
+                 window=1000,
+                 min_samples=100,
+                 loop=None):
+        if not 0 < hedge_quantile < 1:
+            raise ValueError("Invalid hedge_quantile: must be in (0, 1)")
+        if min_samples > window:
+            raise ValueError("Invalid min_samples: must be <= window")
+        self._connections = list(connections)
+        self._hedge_quantile = hedge_quantile
+        self._min_hedge_delay = min_hedge_delay
+        self._max_hedge_delay = max_hedge_delay
+        self._hedge_budget = hedge_budget
+        self._window = window
+        self._min_samples = min_samples
+        self._loop = loop or asyncio.get_running_loop()
+        self._latency = Histogram()
+        self._hedge_delay = None
+        self._calls = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._scatters = 0
+
+    @property
+    def connections(self):
+        return list(self._connections)
+
+    async def hedged_call(self, payload, func_id, **kwargs):
+        """
+        Invoke a remote function, hedging slow calls on a second replica.
+        Accepts the same arguments as SMFConnection.call.
+        """
+        self._calls += 1
+        primary = self._pick()
+        delay = self._hedge_delay
+        if (delay is None or self._hedges >= self._hedge_budget * self._calls
+                or self._pick(primary, required=False) is None):
+            return await self._attempt(primary, payload, func_id, kwargs)
+        first = asyncio.ensure_future(self._attempt(primary, payload, func_id,
+                                                    kwargs),
+                                      loop=self._loop)
+        try:
+            await asyncio.wait((first, ), timeout=delay, loop=self._loop)
+        except BaseException:
+            first.cancel()
+            raise
+        if first.done():
+            return first.result()
+        secondary = self._pick(primary, required=False)
+        if secondary is None:
+            return await first
+        self._hedges += 1
+        hedge = asyncio.ensure_future(self._attempt(secondary, payload,
+                                                    func_id, kwargs),
+                                      loop=self._loop)
+        pending = {first, hedge}
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                    loop=self._loop)
+                # prefer the primary if both completed
+                for task in (first, hedge):
+                    if task in done and task.exception() is None:
+                        if task is hedge:
+                            self._hedge_wins += 1
+                        loser = hedge if task is first else first
+                        if loser in done and loser.exception() is None:
+                            # the losing reply may hold a pooled buffer
+                            owner = secondary if loser is hedge else primary
+                            owner.release(loser.result()[0])
+                        return task.result()
+                if not pending:
+                    return hedge.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def scatter(self, payload, func_id, *, wait="all", **kwargs):
+        """
+        Invoke a remote function on every live replica.
+
+        Args:
+          wait: "all", "quorum" (a majority), "first" or the number of
+            replies to wait for. Calls still outstanding then are cancelled.
+          kwargs: passed through to SMFConnection.call.
+        Returns:
+          A list of at least the awaited number of (connection, reply) tuples
+          in the order the replies arrived.
+        """
+        conns = [c for c in self._connections if not c.closed]
+        n = len(conns)
+        if wait == "all":
+            k = n
+        elif wait == "quorum":
+            k = n // 2 + 1
+        elif wait == "first":
+            k = 1
+        elif isinstance(wait, int):
+            k = wait
+        else:
+            raise ValueError("Invalid wait: {!r}. Expected 'all', 'quorum', "
+                             "'first' or a number of replies".format(wait))
+        if not 0 < k <= n:
+            raise ValueError("Cannot wait for {} of {} live replicas".format(
+                k, n))
+        self._scatters += 1
+        # task -> connection
+        tasks = {}
+        for conn in conns:
+            coro = self._attempt(conn, payload, func_id, kwargs)
+            task = asyncio.ensure_future(coro, loop=self._loop)
+            tasks[task] = conn
+        replies = []
+        errors = []
+        pending = set(tasks)
+        try:
+            while len(replies) < k:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                    loop=self._loop)
+                for task in done:
+                    if task.exception() is None:
+                        replies.append((tasks[task], task.result()))
+                    else:
+                        errors.append(task.exception())
+                if len(errors) > n - k:
+                    raise Exception("{} of {} replicas failed".format(
+                        len(errors), n)) from errors[0]
+        except BaseException:
+            for conn, reply in replies:
+                conn.release(reply[0])
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+        return replies
+
+    def stats(self):
+        return {
+            "calls": self._calls,
+            "hedges": self._hedges,
+            "hedge_wins": self._hedge_wins,
+            "hedge_delay": self._hedge_delay,
+            "scatters": self._scatters,
+        }
+
+    def _pick(self, exclude=None, required=True):
+        # the live connection with the fewest outstanding requests
+        conn = None
+        least = None
+        for c in self._connections:
+            if c is exclude or c.closed:
+                continue
+            n = len(c._sessions)
+            if least is None or n < least:
+                conn, least = c, n
+                if n == 0:
+                    break
+        if conn is None and required:
+            raise Exception("No live replicas")
+        return conn
+
+    async def _attempt(self, conn, payload, func_id, kwargs):
+        start = self._loop.time()
+        reply = await conn.call(payload, func_id, **kwargs)
+        self._record(self._loop.time() - start)
+        return reply
+
+    def _record(self, seconds):
+        latency = self._latency
+        latency.record(seconds * 1000000)
+        if latency.count % self._min_samples == 0:
+            delay = latency.percentile(self._hedge_quantile) / 1000000
+            self._hedge_delay = min(max(delay, self._min_hedge_delay),
+                                    self._max_hedge_delay)
+        if latency.count >= self._window:
+            self._latency = Histogram()
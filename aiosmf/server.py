@@ -0,0 +1,402 @@
+import os
+import reprlib
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing
+
+from .util import (parse_address, unix_path)
+from .frame import (FrameReader, build_header)
+from .headers import DEADLINE_HEADER, STATUS_TIMEOUT, reusable_builder
+from .connection import _Context, _ContextPool
+from .stream import (STATUS_NO_CONTENT, STATUS_PARTIAL_CONTENT,
+                     STREAM_WINDOW_HEADER, STREAM_CREDITS_HEADER,
+                     END_OF_STREAM)
+
+from .constants import (COMPRESSION_NONE, COMPRESSION_DISABLED)
+
+__all__ = [
+    "create_server",
+    "run_server",
+    "SMFServer",
+]
+
+logger = logging.getLogger("smf")
+
+STATUS_OK = 200
+STATUS_NOT_FOUND = 404
+STATUS_ERROR = 500
+
+
+async def create_server(address,
+                        handlers,
+                        *,
+                        incoming_filters=(),
+                        outgoing_filters=(),
+                        reuse_port=False,
+                        loop=None):
+    """Creates an smf server listening on an address.
+
+    Handlers are coroutine functions keyed by the request meta, which is the
+    xor of the service id and the method id. A handler receives the request
+    context and returns a tuple of the reply payload and status, optionally
+    followed by a dict of reply headers. Requests carrying a deadline header
+    are answered with status 504 if the handler runs past it. Handlers that
+    are async generators stream their replies to SMFConnection.stream, one
+    partial reply per yielded payload. Their deadline bounds the time taken
+    to yield each reply.
+
+    Args:
+      address: host:port, or unix:/path for a unix domain socket, to listen
+        on.
+      handlers: dict mapping meta to handler.
+      reuse_port: set SO_REUSEPORT so that several processes can accept
+        connections on the same address.
+    Returns:
+      The new server.
+    """
+    server = SMFServer(handlers,
+                       incoming_filters=incoming_filters,
+                       outgoing_filters=outgoing_filters,
+                       loop=loop)
+    await server.listen(address, reuse_port=reuse_port)
+    return server
+
+
+def run_server(address, handlers, *, workers=1, **kwargs):
+    """Runs an smf server until interrupted.
+
+    With more than one worker the server is forked into worker processes that
+    share the listening address through SO_REUSEPORT, letting the kernel
+    spread connections across cores.
+
+    Args:
+      address: host:port to listen on.
+      handlers: dict mapping meta to handler, or a callable returning one
+        which is invoked in each worker.
+      workers: number of server processes.
+      kwargs: passed through to create_server.
+    """
+    if workers < 1:
+        raise ValueError("Invalid workers: must be >= 1")
+    if workers == 1:
+        _run_worker(address, handlers, kwargs)
+        return
+    if unix_path(address) is not None:
+        raise ValueError("Multiple workers require a TCP address")
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise NotImplementedError("SO_REUSEPORT not supported")
+    kwargs["reuse_port"] = True
+    ctx = multiprocessing.get_context("fork")
+    procs = [
+        ctx.Process(target=_run_worker, args=(address, handlers, kwargs))
+        for _ in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+
+
+def _run_worker(address, handlers, kwargs):
+    if callable(handlers):
+        handlers = handlers()
+
+    async def serve():
+        server = await create_server(address, handlers, **kwargs)
+        logger.info("Worker %d serving on %s", os.getpid(), address)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        try:
+            await stop
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+class SMFServer:
+    """
+    An smf rpc server.
+
+    Requests are dispatched on the header meta through a dict of handlers.
+    Every request runs in its own task so that slow handlers don't delay
+    other sessions on the same connection.
+    """
+
+    def __init__(self,
+                 handlers=None,
+                 *,
+                 incoming_filters=(),
+                 outgoing_filters=(),
+                 loop=None):
+        self._handlers = dict(handlers or {})
+        self._incoming_filters = incoming_filters
+        self._outgoing_filters = outgoing_filters
+        self._loop = loop or asyncio.get_running_loop()
+        self._server = None
+        self._protocols = set()
+
+    def __repr__(self):
+        return "<SMFServer {}>".format(self.sockets)
+
+    @property
+    def sockets(self):
+        if self._server is None:
+            return ()
+        return self._server.sockets
+
+    def register(self, meta, handler):
+        """Registers a handler for a meta (service id ^ method id)."""
+        self._handlers[meta] = handler
+
+    async def listen(self, address, *, reuse_port=False):
+        factory = lambda: _ServerProtocol(self)
+        path = unix_path(address)
+        if path is not None:
+            self._server = await self._loop.create_unix_server(factory, path)
+            return
+        host, port = parse_address(address)
+        self._server = await self._loop.create_server(factory,
+                                                      host,
+                                                      port,
+                                                      reuse_port=reuse_port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for protocol in list(self._protocols):
+            protocol.close()
+
+    async def wait_closed(self):
+        self.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _dispatch(self, ctx):
+        pending = ctx.apply(self._incoming_filters)
+        if pending is not None:
+            await pending
+        if ctx.compression != COMPRESSION_NONE:
+            return "Unsupported compression {}".format(
+                ctx.compression).encode(), STATUS_ERROR
+        handler = self._handlers.get(ctx.meta)
+        if handler is None:
+            return "No handler for meta {}".format(
+                ctx.meta).encode(), STATUS_NOT_FOUND
+        timeout = ctx.get_header(DEADLINE_HEADER)
+        try:
+            reply = handler(ctx)
+            if hasattr(reply, "__aiter__"):
+                if ctx.get_header(STREAM_WINDOW_HEADER) is None:
+                    return "Handler for meta {} streams replies".format(
+                        ctx.meta).encode(), STATUS_ERROR
+                # served by the protocol, see _ServerProtocol._serve_stream
+                return reply
+            if timeout is None:
+                return await reply
+            return await asyncio.wait_for(reply,
+                                          int(timeout) / 1000,
+                                          loop=self._loop)
+        except asyncio.TimeoutError:
+            return b"Deadline exceeded", STATUS_TIMEOUT
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Handler for meta %d failed", ctx.meta)
+            return "{}: {}".format(type(e).__name__, e).encode(), STATUS_ERROR
+
+
+class _ServerProtocol(asyncio.Protocol):
+    """Reads the requests of a client connection and writes their replies."""
+
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+        self._frames = FrameReader()
+        self._tasks = set()
+        self._streams = {}
+        self._writable = asyncio.Event()
+        self._writable.set()
+        # replies don't leave the protocol, so their contexts are reused
+        self._contexts = _ContextPool()
+        self._header_builder = reusable_builder()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET,
+                                                socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._server._protocols.add(self)
+
+    def connection_lost(self, exc):
+        self._server._protocols.discard(self)
+        for task in self._tasks:
+            task.cancel()
+        self._writable.set()
+
+    def pause_writing(self):
+        self._transport.pause_reading()
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._transport.resume_reading()
+        self._writable.set()
+
+    def data_received(self, data):
+        try:
+            self._frames.feed(data, self._handle_frame)
+        except Exception:
+            logger.exception("Server protocol received exception")
+            self._transport.close()
+
+    def close(self):
+        self._transport.close()
+
+    def _handle_frame(self, header, payload, headers):
+        compression, _, session_id, _, _, meta = header
+        if compression == COMPRESSION_DISABLED:
+            compression = COMPRESSION_NONE
+        if headers is not None and STREAM_CREDITS_HEADER in headers:
+            # control frames may arrive after their stream ended
+            credits = self._streams.get(session_id)
+            if credits is not None:
+                credits.grant(int(headers.get(STREAM_CREDITS_HEADER)))
+            return
+        ctx = _Context(payload, meta, session_id, compression, headers)
+        task = asyncio.ensure_future(self._serve(ctx), loop=self._server._loop)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _serve(self, ctx):
+        try:
+            result = await self._server._dispatch(ctx)
+            if hasattr(result, "__aiter__"):
+                await self._serve_stream(ctx, result)
+                return
+            _check_result(ctx, result)
+            await self._send_reply(ctx.session_id, *result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the client would otherwise wait for the reply until it times out
+            logger.exception("Reply for meta %d failed", ctx.meta)
+            message = "{}: {}".format(type(e).__name__, e).encode()
+            try:
+                await self._send_reply(ctx.session_id, message, STATUS_ERROR)
+            except Exception:
+                logger.exception("Error reply for meta %d failed", ctx.meta)
+
+    async def _serve_stream(self, ctx, replies):
+        """
+        Sends the payloads of an async iterator as partial replies, followed by
+        a final reply. No more partial replies are sent than the client
+        granted credits for.
+        """
+        loop = self._server._loop
+        credits = _StreamCredits(int(ctx.get_header(STREAM_WINDOW_HEADER)),
+                                 loop)
+        self._streams[ctx.session_id] = credits
+        # the deadline of a stream bounds each reply, as the client's
+        # timeout does
+        timeout = ctx.get_header(DEADLINE_HEADER)
+        if timeout is not None:
+            timeout = int(timeout) / 1000
+        result = (END_OF_STREAM, STATUS_NO_CONTENT)
+        it = replies.__aiter__()
+        try:
+            while await credits.acquire():
+                if timeout is None:
+                    payload = await it.__anext__()
+                else:
+                    payload = await asyncio.wait_for(it.__anext__(),
+                                                     timeout,
+                                                     loop=loop)
+                if self._transport.is_closing():
+                    return
+                await self._send_reply(ctx.session_id, payload,
+                                       STATUS_PARTIAL_CONTENT)
+                await self._writable.wait()
+        except StopAsyncIteration:
+            pass
+        except asyncio.TimeoutError:
+            result = (b"Deadline exceeded", STATUS_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Stream handler for meta %d failed", ctx.meta)
+            message = "{}: {}".format(type(e).__name__, e)
+            result = (message.encode(), STATUS_ERROR)
+        finally:
+            del self._streams[ctx.session_id]
+            aclose = getattr(it, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await self._send_reply(ctx.session_id, *result)
+
+    async def _send_reply(self, session_id, payload, status, headers=None):
+        reply = self._contexts.get(payload, status, session_id,
+                                   COMPRESSION_NONE, headers)
+        pending = reply.apply(self._server._outgoing_filters)
+        if pending is not None:
+            await pending
+        if self._transport.is_closing():
+            return
+        header = build_header(reply.compression, reply.session_id,
+                              reply.payload, reply.meta, reply.headers, None,
+                              self._header_builder)
+        self._transport.writelines((header, reply.payload))
+        self._contexts.put(reply)
+
+
+def _check_result(ctx, result):
+    if not isinstance(result, tuple) or len(result) not in (2, 3) \
+            or not isinstance(result[0], (bytes, bytearray, memoryview)) \
+            or not isinstance(result[1], int):
+        raise Exception("Handler for meta {} returned {}, expected a "
+                        "(bytes, status[, headers]) tuple".format(
+                            ctx.meta, reprlib.repr(result)))
+
+
+class _StreamCredits:
+    """Partial replies a stream may send, granted by the client."""
+
+    def __init__(self, window, loop):
+        self._available = window
+        self._cancelled = False
+        self._waiter = None
+        self._loop = loop
+
+    def grant(self, n):
+        if n <= 0:
+            self._cancelled = True
+        else:
+            self._available += n
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def acquire(self):
+        """Takes a credit, returning False if the stream was cancelled."""
+        while not self._available and not self._cancelled:
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        if self._cancelled:
+            return False
+        self._available -= 1
+        return True
@@ -0,0 +1,365 @@
+import os
+import math
+import socket
+import struct
+import asyncio
+import threading
+import itertools
+import multiprocessing
+
+from .pool import create_pool
+from .util import SharedDrain
+
+__all__ = [
+    "create_sharded_client",
+    "ShardedClient",
+]
+
+# call id, func id, timeout in seconds (nan for none), priority, payload size
+_REQUEST = struct.Struct("<IIdBI")
+# call id, reply kind, meta, payload size
+_REPLY = struct.Struct("<IBII")
+
+_REPLY_OK = 0
+_REPLY_ERROR = 1
+_REPLY_TIMEOUT = 2
+
+
+async def create_sharded_client(addresses,
+                                *,
+                                shards=None,
+                                processes=False,
+                                setup=None,
+                                loop=None,
+                                **kwargs):
+    """Creates a client whose connections are spread over several event loops.
+
+    Every shard runs its own event loop with its own SMFPool, in a thread or,
+    with processes=True, in a forked process. Thread shards share payloads
+    without copying but only run in parallel where the GIL is released:
+    socket io, compression and checksums of large payloads. Process shards
+    also run framing and filters in parallel and exchange payloads with the
+    client over a socket pair, without pickling.
+
+    Args:
+      addresses: a host:port string or a list of them.
+      shards: number of shards, defaults to the number of CPUs.
+      processes: run shards in processes instead of threads.
+      setup: callable invoked in each shard and returning extra create_pool
+        arguments, so that every shard gets its own filter instances.
+        Thread shards only take filters from setup.
+      kwargs: passed through to create_pool.
+    Returns:
+      The new client.
+    """
+    if shards is None:
+        shards = os.cpu_count() or 1
+    if shards < 1:
+        raise ValueError("Invalid shards: must be >= 1")
+    if not processes and setup is None \
+            and (kwargs.get("incoming_filters") or kwargs.get("outgoing_filters")):
+        raise ValueError("Invalid filters: thread shards can't share filters, "
+                         "create them in setup")
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    shard_class = _ProcessShard if processes else _ThreadShard
+    client = ShardedClient(
+        [shard_class(addresses, setup, kwargs, loop) for _ in range(shards)],
+        loop=loop)
+    # every shard is done starting before any is closed
+    results = await asyncio.gather(*(shard.start()
+                                     for shard in client._shards),
+                                   loop=loop,
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            await client.wait_closed()
+            raise result
+    return client
+
+
+class ShardedClient:
+    """
+    Routes calls to shards round-robin, or by affinity key.
+    """
+
+    def __init__(self, shards, *, loop=None):
+        self._shards = shards
+        self._loop = loop or asyncio.get_running_loop()
+        self._next = itertools.cycle(shards)
+        self._closed = False
+
+    def __repr__(self):
+        return "<ShardedClient {} shards>".format(len(self._shards))
+
+    async def call(self, payload, func_id, *, key=None, **kwargs):
+        """
+        Invoke a remote function on a shard. Accepts the same arguments as
+        SMFConnection.call.
+
+        Args:
+          key: calls with equal keys go to the same shard, otherwise shards
+            are used round-robin.
+        """
+        if self._closed:
+            raise Exception("{} closed".format(self))
+        if key is None:
+            shard = next(self._next)
+        else:
+            shard = self._shards[hash(key) % len(self._shards)]
+        shard.calls += 1
+        shard.in_flight += 1
+        try:
+            return await shard.call(payload, func_id, kwargs)
+        finally:
+            shard.in_flight -= 1
+
+    def stats(self):
+        """Returns the calls and calls in flight of every shard."""
+        return [{
+            "calls": shard.calls,
+            "in_flight": shard.in_flight,
+        } for shard in self._shards]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for shard in self._shards:
+            shard.close()
+
+    async def wait_closed(self):
+        self.close()
+        await asyncio.gather(*(shard.wait_closed() for shard in self._shards),
+                             loop=self._loop)
+
+
+def _pool_kwargs(setup, kwargs):
+    if setup is None:
+        return kwargs
+    return dict(kwargs, **setup())
+
+
+class _ThreadShard:
+    """A pool running on an event loop in its own thread."""
+
+    def __init__(self, addresses, setup, kwargs, loop):
+        self._addresses = addresses
+        self._setup = setup
+        self._kwargs = kwargs
+        self._client_loop = loop
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run,
+                                        name="smf-shard",
+                                        daemon=True)
+        self._pool = None
+        self.calls = 0
+        self.in_flight = 0
+
+    async def start(self):
+        self._thread.start()
+        self._pool = await self._submit(self._connect())
+
+    async def call(self, payload, func_id, kwargs):
+        return await self._submit(self._pool.call(payload, func_id, **kwargs))
+
+    def close(self):
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+
+    async def wait_closed(self):
+        self.close()
+        if self._thread.ident is not None:
+            await self._client_loop.run_in_executor(None, self._thread.join)
+        if not self._loop.is_closed():
+            self._loop.close()
+
+    async def _connect(self):
+        return await create_pool(self._addresses,
+                                 loop=self._loop,
+                                 **_pool_kwargs(self._setup, self._kwargs))
+
+    async def _shutdown(self):
+        try:
+            if self._pool is not None:
+                await self._pool.wait_closed()
+        finally:
+            self._loop.stop()
+
+    def _submit(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return asyncio.wrap_future(future, loop=self._client_loop)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+
+class _ProcessShard:
+    """
+    A pool running in a forked process, relaying calls over a socket pair.
+
+    Requests and replies are sent as a fixed size header followed by the
+    payload. The first reply, with call id 0, reports whether the pool was
+    created.
+    """
+
+    def __init__(self, addresses, setup, kwargs, loop):
+        self._addresses = addresses
+        self._setup = setup
+        self._kwargs = kwargs
+        self._loop = loop
+        self._proc = None
+        self._writer = None
+        self._drainer = None
+        self._reader_task = None
+        self._calls = {}
+        self._call_ids = itertools.count(1)
+        self.calls = 0
+        self.in_flight = 0
+
+    async def start(self):
+        sock, child_sock = socket.socketpair()
+        ctx = multiprocessing.get_context("fork")
+        self._proc = ctx.Process(target=_run_shard,
+                                 args=(child_sock, self._addresses,
+                                       self._setup, self._kwargs),
+                                 daemon=True)
+        self._proc.start()
+        child_sock.close()
+        reader, self._writer = await asyncio.open_connection(sock=sock,
+                                                             loop=self._loop)
+        self._drainer = SharedDrain(self._writer, self._loop)
+        started = self._loop.create_future()
+        self._calls[0] = started
+        self._reader_task = asyncio.ensure_future(self._read_replies(reader),
+                                                  loop=self._loop)
+        await started
+
+    async def call(self, payload, func_id, kwargs):
+        if self._reader_task.done():
+            raise Exception("Shard process exited")
+        if kwargs.get("headers"):
+            raise ValueError("Process shards don't support headers")
+        timeout = kwargs.get("timeout")
+        priority = kwargs.get("priority", 0)
+        call_id = next(self._call_ids) & 0xffffffff or 1
+        future = self._loop.create_future()
+        self._calls[call_id] = future
+        try:
+            self._writer.write(
+                _REQUEST.pack(call_id, func_id,
+                              math.nan if timeout is None else timeout,
+                              priority, len(payload)))
+            self._writer.write(payload)
+            await self._drainer.wait()
+            return await future
+        finally:
+            self._calls.pop(call_id, None)
+
+    def close(self):
+        # forked shards hold copies of the socket, so closing it wouldn't
+        # signal the end of requests
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write_eof()
+
+    async def wait_closed(self):
+        self.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task,
+                                 loop=self._loop,
+                                 return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        if self._proc is not None:
+            await self._loop.run_in_executor(None, self._proc.join)
+
+    async def _read_replies(self, reader):
+        exc = Exception("Shard process exited")
+        try:
+            while True:
+                call_id, kind, meta, size = _REPLY.unpack(
+                    await reader.readexactly(_REPLY.size))
+                payload = await reader.readexactly(size)
+                future = self._calls.pop(call_id, None)
+                if future is None or future.done():
+                    continue
+                if kind == _REPLY_OK:
+                    future.set_result((payload, meta))
+                elif kind == _REPLY_TIMEOUT:
+                    future.set_exception(asyncio.TimeoutError())
+                else:
+                    future.set_exception(Exception(payload.decode()))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            exc.__cause__ = e
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(exc)
+            self._calls.clear()
+
+
+def _run_shard(sock, addresses, setup, kwargs):
+    try:
+        asyncio.run(_serve_shard(sock, addresses, setup, kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_shard(sock, addresses, setup, kwargs):
+    reader, writer = await asyncio.open_connection(sock=sock)
+    drainer = SharedDrain(writer, asyncio.get_running_loop())
+
+    def reply(call_id, kind, meta, payload):
+        writer.write(_REPLY.pack(call_id, kind, meta, len(payload)))
+        writer.write(payload)
+
+    try:
+        pool = await create_pool(addresses, **_pool_kwargs(setup, kwargs))
+    except Exception as e:
+        reply(0, _REPLY_ERROR, 0, "{}: {}".format(type(e).__name__,
+                                                  e).encode())
+        writer.close()
+        return
+    reply(0, _REPLY_OK, 0, b"")
+
+    async def relay(call_id, payload, func_id, timeout, priority):
+        try:
+            result, meta = await pool.call(payload,
+                                           func_id,
+                                           timeout=timeout,
+                                           priority=priority)
+        except asyncio.TimeoutError:
+            reply(call_id, _REPLY_TIMEOUT, 0, b"")
+        except Exception as e:
+            reply(call_id, _REPLY_ERROR, 0,
+                  "{}: {}".format(type(e).__name__, e).encode())
+        else:
+            reply(call_id, _REPLY_OK, meta, result)
+        # bounds the replies buffered for a slow client
+        await drainer.wait()
+
+    tasks = set()
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(_REQUEST.size)
+            except asyncio.IncompleteReadError:
+                break
+            call_id, func_id, timeout, priority, size = _REQUEST.unpack(header)
+            payload = await reader.readexactly(size)
+            if math.isnan(timeout):
+                timeout = None
+            task = asyncio.ensure_future(
+                relay(call_id, payload, func_id, timeout, priority))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        pool.close()
+        await pool.wait_closed()
+        writer.close()
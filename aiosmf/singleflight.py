@@ -0,0 +1,92 @@
+import asyncio
+
+from .util import payload_checksum
+from .cache import _detach
+
+__all__ = [
+    "SingleFlight",
+]
+
+
+class _Flight:
+    __slots__ = ("payload", "task", "waiters")
+
+    def __init__(self, payload, task):
+        self.payload = payload
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls to a connection or pool.
+
+    A call made while an identical one, with the same function id and payload,
+    is still in flight doesn't send a request of its own but waits for the
+    reply of the in-flight call. The call options of the first caller apply to
+    the shared call, and the shared call is cancelled only when every caller
+    waiting for it was cancelled. Calls passing headers are never coalesced.
+
+    Wrapping it in a ResponseCache also coalesces the misses of an expired
+    entry.
+
+    Args:
+      target: an SMFConnection or SMFPool.
+    """
+
+    def __init__(self, target, *, loop=None):
+        self._target = target
+        self._loop = loop or asyncio.get_running_loop()
+        self._flights = {}
+        self._calls = 0
+        self._coalesced = 0
+
+    async def call(self, payload, func_id, **kwargs):
+        """
+        Invokes the function on the target, or joins an identical call in
+        flight, accepting the same arguments as SMFConnection.call.
+        """
+        if kwargs.get("headers"):
+            return await self._target.call(payload, func_id, **kwargs)
+        self._calls += 1
+        key = (func_id, payload_checksum(payload))
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._start(key, payload, func_id, kwargs)
+        elif flight.payload == payload:
+            self._coalesced += 1
+        else:
+            # checksum collision with a different request
+            return await self._target.call(payload, func_id, **kwargs)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+
+    def stats(self):
+        return {
+            "calls": self._calls,
+            "coalesced": self._coalesced,
+            "in_flight": len(self._flights),
+        }
+
+    def _start(self, key, payload, func_id, kwargs):
+        task = asyncio.ensure_future(self._call(payload, func_id, kwargs),
+                                     loop=self._loop)
+        flight = _Flight(bytes(payload), task)
+        self._flights[key] = flight
+
+        def done(_):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        task.add_done_callback(done)
+        return flight
+
+    async def _call(self, payload, func_id, kwargs):
+        reply = await self._target.call(payload, func_id, **kwargs)
+        # every waiter gets the same payload
+        return _detach(self._target, reply[0]), reply[1]
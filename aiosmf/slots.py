@@ -0,0 +1,137 @@
+import asyncio
+import collections
+
+__all__ = [
+    "MAX_SESSIONS",
+    "SlotAllocator",
+]
+
+# session ids are uint16_t
+MAX_SESSIONS = 65536
+
+# abandoned session ids are held back from reuse until their late reply
+# arrives. past this many the oldest are recycled anyway.
+MAX_ABANDONED = 4096
+
+
+class SlotAllocator:
+    """
+    Allocates session ids and bounds the number of requests in flight.
+
+    Ids that have never been used are handed out first, after which released
+    ids are reused in FIFO order so that an id stays idle for as long as
+    possible before it is reused. Allocation and release are O(1). Callers
+    that find the window full wait in FIFO order for a slot to be released.
+
+    An abandoned session (its caller gave up on the reply) frees its window
+    slot immediately but its id is quarantined until the late reply arrives,
+    so that the reply cannot be mistaken for one to a newer request.
+    """
+
+    def __init__(self, max_in_flight=None, *, loop=None):
+        if max_in_flight is None:
+            max_in_flight = MAX_SESSIONS
+        if not 0 < max_in_flight <= MAX_SESSIONS:
+            raise ValueError(
+                "Invalid max_in_flight: must be in [1, {}]".format(
+                    MAX_SESSIONS))
+        self._loop = loop or asyncio.get_running_loop()
+        self._max_in_flight = max_in_flight
+        self._next_id = 0
+        self._free = collections.deque()
+        self._in_flight = 0
+        self._peak = 0
+        self._waits = 0
+        self._waiters = collections.deque()
+        self._abandoned = collections.OrderedDict()
+        self._abandons = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def try_acquire(self):
+        """Returns a session id, or None if none is available right now."""
+        if self._waiters or self._in_flight >= self._max_in_flight \
+                or not self._has_free_id():
+            return None
+        return self._take()
+
+    async def acquire(self):
+        """Returns a session id, waiting for one to be released if needed."""
+        session_id = self.try_acquire()
+        if session_id is not None:
+            return session_id
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        self._waits += 1
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over as we were cancelled
+                self.release(waiter.result())
+            raise
+
+    def release(self, session_id):
+        self._in_flight -= 1
+        self._free.append(session_id)
+        self._wake()
+
+    def abandon(self, session_id):
+        """Frees the slot of a session whose reply is no longer wanted."""
+        self._in_flight -= 1
+        self._abandons += 1
+        self._abandoned[session_id] = None
+        if len(self._abandoned) > MAX_ABANDONED:
+            oldest, _ = self._abandoned.popitem(last=False)
+            self._free.append(oldest)
+        self._wake()
+
+    def reclaim(self, session_id):
+        """
+        Returns the id of an abandoned session to the free list once its late
+        reply arrived. Returns False if the session was not abandoned.
+        """
+        try:
+            del self._abandoned[session_id]
+        except KeyError:
+            return False
+        self._free.append(session_id)
+        self._wake()
+        return True
+
+    def stats(self):
+        return {
+            "in_flight": self._in_flight,
+            "max_in_flight": self._max_in_flight,
+            "peak_in_flight": self._peak,
+            "occupancy": self._in_flight / self._max_in_flight,
+            "free_ids": len(self._free) + MAX_SESSIONS - self._next_id,
+            "waiting": len(self._waiters),
+            "waits": self._waits,
+            "abandoned": self._abandons,
+            "quarantined": len(self._abandoned),
+        }
+
+    def _has_free_id(self):
+        return self._free or self._next_id < MAX_SESSIONS
+
+    def _take(self):
+        if self._free:
+            session_id = self._free.popleft()
+        else:
+            session_id = self._next_id
+            self._next_id += 1
+        self._in_flight += 1
+        if self._in_flight > self._peak:
+            self._peak = self._in_flight
+        return session_id
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self._max_in_flight \
+                and self._has_free_id():
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            waiter.set_result(self._take())
@@ -0,0 +1,202 @@
+import asyncio
+import collections
+
+from .util import payload_checksum
+from .frame import ChecksumError
+from .headers import DEADLINE_HEADER, STATUS_TIMEOUT
+from .tracing import STAGE_CALL
+
+from .constants import COMPRESSION_NONE
+
+__all__ = [
+    "ReplyStream",
+    "STATUS_NO_CONTENT",
+    "STATUS_PARTIAL_CONTENT",
+    "STREAM_WINDOW_HEADER",
+    "STREAM_CREDITS_HEADER",
+]
+
+# A streaming call is a request carrying the window header. The server replies
+# with any number of partial frames on the request's session and ends the
+# stream with a frame of any other status: no content for a clean end, or
+# for example an error.
+STATUS_NO_CONTENT = 204
+STATUS_PARTIAL_CONTENT = 206
+
+# number of partial frames the server may send ahead of the client
+STREAM_WINDOW_HEADER = "smf-stream-window"
+
+# Frames carrying the credits header are stream control frames sent by the
+# client on the session of a stream. The value is the number of partial
+# frames consumed, granting the server as many more, or 0 to cancel the
+# stream.
+STREAM_CREDITS_HEADER = "smf-stream-credits"
+# frames need a non-zero meta, which is ignored for control frames
+STREAM_CONTROL_META = STATUS_PARTIAL_CONTENT
+
+# smf frames can't have an empty body
+END_OF_STREAM = b"\0"
+
+
+class ReplyStream:
+    """
+    Async iterator over the replies of a streaming call.
+
+    Yields (payload, meta) tuples. Partial replies have meta 206, and a final
+    reply with any status other than 204 is yielded as the last item. A 504
+    reply to a propagated deadline raises asyncio.TimeoutError instead. At
+    most window replies are buffered: the server only sends more once the
+    replies before them were consumed.
+
+    Closing the stream before its end tells the server to stop sending.
+    """
+
+    def __init__(self, connection, ctx, window, timeout):
+        self._conn = connection
+        self._ctx = ctx
+        self._window = window
+        self._timeout = timeout
+        self._start = connection._loop.time()
+        self._frames = collections.deque()
+        self._waiter = None
+        self._exc = None
+        self._ended = False
+        self._closed = False
+        self._consumed = 0
+        self._wire_bytes = 0
+        self._bytes = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def __anext__(self):
+        while not self._frames:
+            if self._exc is not None:
+                self.close()
+                raise self._exc
+            if self._ended or self._closed:
+                raise StopAsyncIteration
+            self._waiter = self._conn._loop.create_future()
+            try:
+                if self._timeout is None:
+                    await self._waiter
+                else:
+                    await asyncio.wait_for(self._waiter,
+                                           self._timeout,
+                                           loop=self._conn._loop)
+            except BaseException:
+                self.close()
+                raise
+            finally:
+                self._waiter = None
+        recv_ctx = self._frames.popleft()
+        if recv_ctx.meta == STATUS_PARTIAL_CONTENT:
+            self._consumed += 1
+            if self._consumed >= (self._window + 1) // 2 and not self._ended:
+                self._conn._send_stream_control(self._ctx.session_id,
+                                                self._consumed)
+                self._consumed = 0
+        elif recv_ctx.meta == STATUS_NO_CONTENT:
+            self._conn.release(recv_ctx.payload)
+            self._finish()
+            raise StopAsyncIteration
+        try:
+            await self._decode(recv_ctx)
+        except BaseException:
+            self.close()
+            raise
+        if recv_ctx.meta != STATUS_PARTIAL_CONTENT:
+            self._finish()
+            if recv_ctx.meta == STATUS_TIMEOUT \
+                    and self._ctx.get_header(DEADLINE_HEADER) is not None:
+                # the server gave up on the propagated deadline just before
+                # wait_for would have
+                self._conn.release(recv_ctx.payload)
+                raise asyncio.TimeoutError()
+        return recv_ctx.payload, recv_ctx.meta
+
+    async def aclose(self):
+        self.close()
+
+    def close(self):
+        """Stops the stream, cancelling it on the server if not ended."""
+        if self._closed:
+            return
+        self._closed = True
+        for recv_ctx in self._frames:
+            self._conn.release(recv_ctx.payload)
+        self._frames.clear()
+        if not self._ended:
+            # the session stays open until the server's final frame
+            self._conn._send_stream_control(self._ctx.session_id, 0)
+            if self._conn._metrics is not None:
+                self._conn._metrics.record_error(self._ctx.meta)
+        self._trace_call()
+
+    # the methods below stand in for the reply future of a session
+
+    def done(self):
+        return self._ended
+
+    def set_result(self, recv_ctx):
+        if recv_ctx.meta != STATUS_PARTIAL_CONTENT:
+            self._ended = True
+        if self._closed:
+            self._conn.release(recv_ctx.payload)
+            return
+        self._frames.append(recv_ctx)
+        self._wake()
+
+    def set_exception(self, exc):
+        self._ended = True
+        if not self._closed:
+            self._exc = exc
+            self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _decode(self, recv_ctx):
+        conn = self._conn
+        payload = recv_ctx.payload
+        self._wire_bytes += len(payload)
+        try:
+            if recv_ctx.checksum is not None:
+                checksum = await conn._loop.run_in_executor(
+                    conn._executor, payload_checksum, payload)
+                if recv_ctx.checksum != checksum:
+                    raise ChecksumError(checksum, recv_ctx.checksum)
+            pending = recv_ctx.apply(conn._incoming_filters)
+            if pending is not None:
+                await pending
+            if recv_ctx.compression != COMPRESSION_NONE:
+                raise Exception("Unexpected reply state")
+        except BaseException:
+            conn.release(recv_ctx.payload)
+            raise
+        finally:
+            if recv_ctx.payload is not payload:
+                conn.release(payload)
+        self._bytes += len(recv_ctx.payload)
+
+    def _finish(self):
+        self._closed = True
+        metrics = self._conn._metrics
+        if metrics is not None:
+            metrics.record_reply(self._ctx.meta,
+                                 self._conn._loop.time() - self._start,
+                                 self._wire_bytes, self._bytes)
+        self._trace_call()
+
+    def _trace_call(self):
+        # the stream spans the whole call, which trace hooks see end once
+        if self._conn._hooks is not None:
+            self._conn._trace(self._ctx, STAGE_CALL, self._start,
+                              self._conn._loop.time())
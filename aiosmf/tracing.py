@@ -0,0 +1,137 @@
+import time
+import random
+
+from .metrics import Histogram
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+__all__ = [
+    "STAGES",
+    "OpenTelemetryHook",
+    "StageProfiler",
+]
+
+# Stages of a client call, in the order they are reported. Hooks receive the
+# call context and event loop times in seconds.
+
+# outgoing filters, such as compression
+STAGE_OUTGOING_FILTERS = "outgoing_filters"
+# header encoding, including the payload checksum
+STAGE_ENCODE = "encode"
+# write and drain, or waiting for the corked flush
+STAGE_WRITE = "write"
+# reading and verifying the reply payload once its header arrived. only
+# reported with the stream transport, SMFProtocol parses replies as data
+# arrives. falls within STAGE_WAIT.
+STAGE_READ = "read"
+# from the end of the write until the caller resumes with the reply: network,
+# server and event loop time
+STAGE_WAIT = "wait"
+# checksum verification deferred to the executor (large replies)
+STAGE_VERIFY = "verify"
+# incoming filters, such as decompression
+STAGE_INCOMING_FILTERS = "incoming_filters"
+# the whole call. always reported last, also for calls that failed
+STAGE_CALL = "call"
+
+STAGES = (STAGE_OUTGOING_FILTERS, STAGE_ENCODE, STAGE_WRITE, STAGE_READ,
+          STAGE_WAIT, STAGE_VERIFY, STAGE_INCOMING_FILTERS, STAGE_CALL)
+
+
+class StageProfiler:
+    """
+    Trace hook aggregating stage timings into per-stage histograms.
+
+    Only a sample_rate fraction of stage timings are recorded, which keeps the
+    profiler cheap enough to leave installed in production.
+    """
+
+    def __init__(self, sample_rate=0.01):
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Invalid sample_rate: must be in (0, 1]")
+        self._sample_rate = sample_rate
+        self._random = random.random
+        self._stages = {}
+
+    def __call__(self, ctx, stage, t_start, t_end):
+        if self._sample_rate < 1 and self._random() >= self._sample_rate:
+            return
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            histogram = Histogram()
+            self._stages[stage] = histogram
+        histogram.record((t_end - t_start) * 1000000)
+
+    def reset(self):
+        self._stages = {}
+
+    def stats(self):
+        """
+        Returns a dict of stage to latency histogram snapshot (microseconds)
+        and the share of the sampled call time spent in the stage.
+        """
+        call = self._stages.get(STAGE_CALL)
+        mean_call = call.sum / call.count if call is not None else 0
+        stats = {}
+        for stage in STAGES:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                continue
+            snapshot = histogram.snapshot()
+            share = None
+            if stage != STAGE_CALL and mean_call:
+                share = snapshot["mean"] / mean_call
+            stats[stage] = {"latency_us": snapshot, "share": share}
+        return stats
+
+
+def _require_otel():
+    if otel_trace is None:
+        raise ImportError(
+            "OpenTelemetry tracing requires the opentelemetry-api package")
+
+
+class OpenTelemetryHook:
+    """
+    Trace hook emitting an OpenTelemetry span per call, with a child span for
+    every stage.
+
+    Stage timings are buffered per call until the call completes, at which
+    point the spans are created with their recorded start and end times. The
+    call span is parented to the span that is current in the calling task.
+    """
+
+    def __init__(self, tracer=None, *, name="smf.call"):
+        _require_otel()
+        if tracer is None:
+            tracer = otel_trace.get_tracer("aiosmf")
+        self._tracer = tracer
+        self._name = name
+        self._pending = {}
+        # asyncio loop time is time.monotonic(), spans want epoch nanoseconds
+        self._offset = time.time() - time.monotonic()
+
+    def __call__(self, ctx, stage, t_start, t_end):
+        if stage != STAGE_CALL:
+            self._pending.setdefault(ctx, []).append((stage, t_start, t_end))
+            return
+        stages = self._pending.pop(ctx, ())
+        attributes = {"smf.func_id": ctx.meta}
+        if ctx.session_id is not None:
+            attributes["smf.session_id"] = ctx.session_id
+        span = self._tracer.start_span(self._name,
+                                       start_time=self._ns(t_start),
+                                       attributes=attributes)
+        parent = otel_trace.set_span_in_context(span)
+        for name, start, end in stages:
+            child = self._tracer.start_span(name,
+                                            context=parent,
+                                            start_time=self._ns(start))
+            child.end(end_time=self._ns(end))
+        span.end(end_time=self._ns(t_end))
+
+    def _ns(self, t):
+        return int((t + self._offset) * 1000000000)
@@ -1,5 +1,19 @@
+import os
+import asyncio
+
 import xxhash
 
+try:
+    from . import _speedups
+except ImportError:
+    _speedups = None
+
+# set AIOSMF_NO_SPEEDUPS to use the pure Python implementation
+if os.environ.get("AIOSMF_NO_SPEEDUPS"):
+    _speedups = None
+
+UNIX_ADDRESS_PREFIX = "unix:"
+
 
 def parse_address(address):
     parts = address.split(":")
@@ -7,6 +21,53 @@ def parse_address(address):
     return parts[0], int(parts[1])
 
 
+def unix_path(address):
+    """Returns the socket path of a unix:/path address, or None."""
+    if address.startswith(UNIX_ADDRESS_PREFIX):
+        return address[len(UNIX_ADDRESS_PREFIX):]
+    return None
+
+
 def payload_checksum(data):
     # uint32_t::max = 4294967295
     return xxhash.xxh64(data).intdigest() & 4294967295
+
+
+if _speedups is not None:
+    payload_checksum = _speedups.checksum
+
+
+def payload_hasher():
+    """Returns a hasher for computing a payload checksum incrementally."""
+    return xxhash.xxh64()
+
+
+def hasher_checksum(hasher):
+    return hasher.intdigest() & 4294967295
+
+
+class SharedDrain:
+    """
+    Drains a StreamWriter for any number of concurrent callers. Before
+    Python 3.8 StreamWriter.drain fails if several callers wait at once, so
+    callers share one drain task. A cancelled caller only stops its own wait.
+    """
+
+    def __init__(self, writer, loop):
+        self._writer = writer
+        self._loop = loop
+        self._task = None
+
+    async def wait(self):
+        task = self._task
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._writer.drain(), loop=self._loop)
+            task.add_done_callback(_retrieve_exception)
+            self._task = task
+        await asyncio.shield(task)
+
+
+def _retrieve_exception(task):
+    # callers may all have stopped waiting for the task
+    if not task.cancelled():
+        task.exception()
@@ -0,0 +1,259 @@
+"""
+Measures SMFConnection.call throughput and latency.
+
+Every combination of event loop, transport, compression, payload size and
+concurrency is run against an aiosmf echo server started in a child process
+(or an external smf server given with --server), and the results are written
+as JSON for comparison with compare.py.
+
+    python benchmarks/bench_call.py --output results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import aiosmf
+from aiosmf.metrics import Histogram
+
+# echo handler meta (service id ^ method id)
+ECHO_META = 0x6563686f
+
+
+def _filters(compression):
+    """Returns the (incoming, outgoing) filters for a compression config."""
+    if compression == "none":
+        return (), ()
+    if compression == "zstd":
+        return ((aiosmf.ZstdDecompressionFilter(), ),
+                (aiosmf.ZstdCompressionFilter(256), ))
+    if compression == "lz4":
+        return ((aiosmf.Lz4DecompressionFilter(), ),
+                (aiosmf.Lz4CompressionFilter(256), ))
+    if compression == "adaptive":
+        return ((aiosmf.ZstdDecompressionFilter(),
+                 aiosmf.Lz4DecompressionFilter()),
+                (aiosmf.AdaptiveCompressionFilter(256), ))
+    raise ValueError("Unknown compression {}".format(compression))
+
+
+def _install_loop(name):
+    if name == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+
+
+def _loop_available(name):
+    if name == "asyncio":
+        return True
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def _payload(size, seed):
+    """A reproducible payload that compresses roughly 2:1."""
+    rng = random.Random(seed)
+    half = size // 2
+    noise = rng.getrandbits(8 * half).to_bytes(half, "little")
+    return noise + bytes(size - half)
+
+
+def _serve(compression, loop_name, ports):
+    _install_loop(loop_name)
+
+    async def echo(ctx):
+        return ctx.payload, 200
+
+    async def serve():
+        incoming, outgoing = _filters(compression)
+        server = await aiosmf.create_server("127.0.0.1:0", {ECHO_META: echo},
+                                            incoming_filters=incoming,
+                                            outgoing_filters=outgoing)
+        ports.put(server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class _Server:
+    """Echo server in a child process, running the benchmarked loop."""
+
+    def __init__(self, compression, loop_name):
+        ctx = multiprocessing.get_context("fork")
+        ports = ctx.Queue()
+        self._proc = ctx.Process(target=_serve,
+                                 args=(compression, loop_name, ports),
+                                 daemon=True)
+        self._proc.start()
+        self.address = "127.0.0.1:{}".format(ports.get(timeout=10))
+
+    def stop(self):
+        self._proc.terminate()
+        self._proc.join()
+
+
+async def _run_case(address, compression, transport, size, concurrency,
+                    duration, warmup):
+    incoming, outgoing = _filters(compression)
+    conn = await aiosmf.create_connection(address,
+                                          incoming_filters=incoming,
+                                          outgoing_filters=outgoing,
+                                          use_protocol=transport == "protocol",
+                                          metrics=False)
+    payload = _payload(size, size)
+    latency = Histogram()
+    loop = asyncio.get_running_loop()
+    state = {"record": False, "stop": False}
+
+    async def worker():
+        while not state["stop"]:
+            start = loop.time()
+            reply, status = await conn.call(payload, ECHO_META)
+            if state["record"]:
+                latency.record((loop.time() - start) * 1000000)
+            if status != 200 or len(reply) != size:
+                raise Exception("Bad echo reply")
+
+    try:
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        await asyncio.sleep(warmup)
+        state["record"] = True
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        state["record"] = False
+        elapsed = time.perf_counter() - start
+        state["stop"] = True
+        await asyncio.gather(*workers)
+    finally:
+        conn.close()
+        await conn.wait_closed()
+    calls = latency.count
+    return {
+        "calls": calls,
+        "seconds": elapsed,
+        "calls_per_sec": calls / elapsed,
+        "mb_per_sec": calls * size / elapsed / 1e6,
+        "latency_us": latency.snapshot(),
+    }
+
+
+def _case_key(case):
+    return "{loop}/{transport}/{compression}/{size}/{concurrency}".format(
+        **case)
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode().strip()
+
+
+def _csv(cast):
+    return lambda s: [cast(v) for v in s.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes",
+                        type=_csv(int),
+                        default=[64, 4096, 65536, 1048576])
+    parser.add_argument("--concurrency", type=_csv(int), default=[1, 16, 128])
+    parser.add_argument("--compression",
+                        type=_csv(str),
+                        default=["none", "zstd", "lz4"])
+    parser.add_argument("--loops",
+                        type=_csv(str),
+                        default=["asyncio", "uvloop"])
+    parser.add_argument("--transports",
+                        type=_csv(str),
+                        default=["stream", "protocol"])
+    parser.add_argument("--duration",
+                        type=float,
+                        default=3.0,
+                        help="measured seconds per case")
+    parser.add_argument("--warmup",
+                        type=float,
+                        default=0.5,
+                        help="unmeasured seconds per case")
+    parser.add_argument("--server",
+                        help="benchmark an external smf server at host:port "
+                        "instead, which must echo meta {}".format(ECHO_META))
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "aiosmf": aiosmf.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "duration": args.duration,
+            "warmup": args.warmup,
+        },
+        "results": [],
+    }
+    for loop_name in args.loops:
+        if not _loop_available(loop_name):
+            print("Skipping {}: not installed".format(loop_name),
+                  file=sys.stderr)
+            continue
+        for compression in args.compression:
+            server = None
+            address = args.server
+            if address is None:
+                server = _Server(compression, loop_name)
+                address = server.address
+            try:
+                _install_loop(loop_name)
+                for transport in args.transports:
+                    for size in args.sizes:
+                        for concurrency in args.concurrency:
+                            case = {
+                                "loop": loop_name,
+                                "transport": transport,
+                                "compression": compression,
+                                "size": size,
+                                "concurrency": concurrency,
+                            }
+                            case.update(
+                                asyncio.run(
+                                    _run_case(address, compression, transport,
+                                              size, concurrency, args.duration,
+                                              args.warmup)))
+                            results["results"].append(case)
+                            latency = case["latency_us"]
+                            print(
+                                "{:<40} {:>10.0f} calls/s {:>9.1f} MB/s "
+                                "p50 {:>7}us p99 {:>7}us p999 {:>7}us".format(
+                                    _case_key(case), case["calls_per_sec"],
+                                    case["mb_per_sec"], latency["p50"],
+                                    latency["p99"], latency["p999"]))
+            finally:
+                if server is not None:
+                    server.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Measures the memory and garbage collected objects held per in-flight call of
+SMFConnection.
+
+The in-flight figures are the traced Python memory and the objects tracked by
+the garbage collector held by N calls waiting for their replies from a server
+that never answers, divided by N. They include the caller's task and
+coroutine frames along with the connection's own per-call state. Fewer
+tracked objects make every collection shorter. Throughput is measured
+against an aiosmf echo server in a child process.
+
+    python benchmarks/bench_memory.py --output memory.json
+"""
+import gc
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tracemalloc
+import multiprocessing
+
+import aiosmf
+
+from bench_call import ECHO_META, _Server, _git_commit
+
+
+def _sink(ports):
+    """A server that reads requests and never replies."""
+
+    async def discard(reader, writer):
+        while await reader.read(1 << 16):
+            pass
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(discard, "127.0.0.1", 0)
+        ports.put(server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class _Sink:
+    """Runs _sink in a child process."""
+
+    def __init__(self):
+        ctx = multiprocessing.get_context("fork")
+        ports = ctx.Queue()
+        self._proc = ctx.Process(target=_sink, args=(ports, ), daemon=True)
+        self._proc.start()
+        self.address = "127.0.0.1:{}".format(ports.get(timeout=10))
+
+    def stop(self):
+        self._proc.terminate()
+        self._proc.join()
+
+
+async def _in_flight(address, calls, size, transport):
+    conn = await aiosmf.create_connection(address,
+                                          use_protocol=transport == "protocol",
+                                          max_in_flight=calls,
+                                          metrics=False)
+    payload = bytes(size)
+    loop = asyncio.get_running_loop()
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tasks = [
+            loop.create_task(conn.call(payload, ECHO_META))
+            for _ in range(calls)
+        ]
+        while len(conn._sessions) < calls:
+            await asyncio.sleep(0.01)
+        # let the last requests reach the socket
+        await asyncio.sleep(0.1)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    # less the tasks list
+    objects = len(gc.get_objects()) - objects - 1
+    conn.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await conn.wait_closed()
+    return held / calls, objects / calls
+
+
+async def _throughput(address, calls, size, concurrency, transport):
+    conn = await aiosmf.create_connection(address,
+                                          use_protocol=transport == "protocol",
+                                          metrics=False)
+    payload = bytes(size)
+    remaining = [calls]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await conn.call(payload, ECHO_META)
+
+    # warm up free lists and caches
+    await asyncio.gather(*(conn.call(payload, ECHO_META)
+                           for _ in range(concurrency)))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    conn.close()
+    await conn.wait_closed()
+    return calls / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--in-flight",
+                        type=int,
+                        default=10000,
+                        help="calls held in flight for the memory figure")
+    parser.add_argument("--calls",
+                        type=int,
+                        default=200000,
+                        help="calls made for the throughput figure")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--transports", default="stream,protocol")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "aiosmf": aiosmf.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": [],
+    }
+    sink = _Sink()
+    server = _Server("none", "asyncio")
+    try:
+        for transport in args.transports.split(","):
+            per_call, objects = asyncio.run(
+                _in_flight(sink.address, args.in_flight, args.size, transport))
+            calls_per_sec = asyncio.run(
+                _throughput(server.address, args.calls, args.size,
+                            args.concurrency, transport))
+            results["results"].append({
+                "transport": transport,
+                "size": args.size,
+                "bytes_per_in_flight_call": per_call,
+                "gc_objects_per_in_flight_call": objects,
+                "calls_per_sec": calls_per_sec,
+            })
+            print("{:<10} {:>6.0f} bytes {:>5.1f} gc objects per in-flight "
+                  "call {:>8.0f} calls/s".format(transport, per_call, objects,
+                                                 calls_per_sec))
+    finally:
+        server.stop()
+        sink.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
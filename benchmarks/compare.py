@@ -0,0 +1,60 @@
+"""
+Compares two bench_call.py result files.
+
+    python benchmarks/compare.py base.json new.json --threshold 0.1
+
+Prints the relative change of throughput and p99 latency for every case that
+is in both files and exits with status 1 if any case regressed by more than
+the threshold.
+"""
+import sys
+import json
+import argparse
+
+
+def _case_key(case):
+    return "{loop}/{transport}/{compression}/{size}/{concurrency}".format(
+        **case)
+
+
+def _load(path):
+    with open(path) as f:
+        results = json.load(f)
+    return results["meta"], {_case_key(r): r for r in results["results"]}
+
+
+def _change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.1,
+                        help="relative regression that fails the comparison")
+    args = parser.parse_args(argv)
+
+    base_meta, base = _load(args.base)
+    new_meta, new = _load(args.new)
+    print("base {} ({})".format(base_meta.get("commit"), base_meta["time"]))
+    print("new  {} ({})".format(new_meta.get("commit"), new_meta["time"]))
+    regressions = 0
+    for key in sorted(base.keys() & new.keys()):
+        throughput = _change(base[key]["calls_per_sec"],
+                             new[key]["calls_per_sec"])
+        p99 = _change(base[key]["latency_us"]["p99"],
+                      new[key]["latency_us"]["p99"])
+        regressed = throughput < -args.threshold or p99 > args.threshold
+        regressions += regressed
+        print("{:<40} calls/s {:>+7.1%}  p99 {:>+7.1%}{}".format(
+            key, throughput, p99, "  REGRESSION" if regressed else ""))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
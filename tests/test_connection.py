@@ -0,0 +1,146 @@
+import sys
+import asyncio
+
+import pytest
+
+from aiosmf.loopback import create_loopback_connection
+
+
+def test_cancelled_drain_leaves_other_waiters():
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        conn = await create_loopback_connection({})
+        drained = loop.create_future()
+        drains = []
+
+        async def drain():
+            drains.append(None)
+            await drained
+
+        conn._writer.drain = drain
+        leader = loop.create_task(conn._drain())
+        await asyncio.sleep(0.01)
+        follower = loop.create_task(conn._drain())
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        assert not follower.done()
+        drained.set_result(None)
+        await follower
+        assert len(drains) == 1
+        conn.close()
+        await conn.wait_closed()
+
+    asyncio.run(run())
+
+
+# asyncio.wait_for lost its loop argument, which aiosmf passes, in 3.10
+uses_wait_for = pytest.mark.skipif(sys.version_info >= (3, 10),
+                                   reason="aiosmf targets Python 3.7")
+
+
+def _run(handlers, test, **kwargs):
+
+    async def run():
+        conn = await create_loopback_connection(handlers, **kwargs)
+        try:
+            await test(conn)
+        finally:
+            conn.close()
+            await conn.wait_closed()
+
+    asyncio.run(run())
+
+
+async def _echo(ctx):
+    return bytes(ctx.payload), 200
+
+
+async def _slow(ctx):
+    await asyncio.sleep(0.2)
+    return b"slow", 200
+
+
+def test_calls_wait_for_a_slot():
+    release = []
+
+    async def held(ctx):
+        while not release:
+            await asyncio.sleep(0.01)
+        return bytes(ctx.payload), 200
+
+    async def test(conn):
+        calls = [
+            asyncio.ensure_future(conn.call(str(i).encode(), 1))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0.05)
+        stats = conn.slot_stats()
+        assert stats["in_flight"] == 2
+        assert stats["waiting"] == 3
+        release.append(None)
+        replies = await asyncio.gather(*calls)
+        assert [p for p, _ in replies] == [str(i).encode() for i in range(5)]
+        assert conn.slot_stats()["peak_in_flight"] == 2
+
+    _run({1: held}, test, max_in_flight=2)
+
+
+@uses_wait_for
+def test_timeout_quarantines_session_until_late_reply():
+
+    async def test(conn):
+        with pytest.raises(asyncio.TimeoutError):
+            await conn.call(b"x", 2, timeout=0.05)
+        stats = conn.slot_stats()
+        assert stats["abandoned"] == 1
+        assert stats["quarantined"] == 1
+        await asyncio.sleep(0.3)
+        stats = conn.slot_stats()
+        assert stats["late_replies"] == 1
+        assert stats["quarantined"] == 0
+        # the reader survived the late reply
+        assert await conn.call(b"y", 1) == (b"y", 200)
+
+    _run({1: _echo, 2: _slow}, test)
+
+
+def test_cancelled_call_quarantines_session():
+
+    async def test(conn):
+        call = asyncio.ensure_future(conn.call(b"x", 2))
+        await asyncio.sleep(0.05)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        assert conn.slot_stats()["quarantined"] == 1
+        await asyncio.sleep(0.3)
+        assert conn.slot_stats()["late_replies"] == 1
+        assert await conn.call(b"y", 1) == (b"y", 200)
+
+    _run({1: _echo, 2: _slow}, test)
+
+
+@uses_wait_for
+def test_timeout_leaves_concurrent_calls():
+
+    async def test(conn):
+        # stop the server from reading so that writers wait for a drain
+        server_transport = conn._writer.transport._peer
+        server_transport.pause_reading()
+        payloads = [bytes([i]) * 100000 for i in range(1, 9)]
+        timed_out = asyncio.ensure_future(
+            conn.call(payloads[0], 1, timeout=0.05))
+        # the call timing out leads the drain that the others wait for
+        await asyncio.sleep(0.01)
+        calls = [asyncio.ensure_future(conn.call(p, 1)) for p in payloads]
+        with pytest.raises(asyncio.TimeoutError):
+            await timed_out
+        await asyncio.sleep(0.05)
+        assert not any(call.done() for call in calls)
+        server_transport.resume_reading()
+        replies = await asyncio.gather(*calls)
+        assert [p for p, _ in replies] == payloads
+
+    _run({1: _echo}, test)
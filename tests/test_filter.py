@@ -0,0 +1,62 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import zstandard as zstd
+
+from aiosmf.connection import _Context
+from aiosmf.filter import (ZstdDictionaries, ZstdCompressionFilter,
+                           ZstdDecompressionFilter)
+from aiosmf.constants import COMPRESSION_ZSTD, COMPRESSION_NONE
+
+
+def _decompress(f, payload):
+    ctx = _Context(payload, 1, 1, COMPRESSION_ZSTD)
+
+    async def run():
+        pending = f(ctx)
+        if pending is not None:
+            await pending
+
+    asyncio.run(run())
+    assert ctx.compression == COMPRESSION_NONE
+    return ctx.payload
+
+
+def test_zstd_decompress_offload():
+    payload = b"smf" * 10000
+    compressed = zstd.ZstdCompressor().compress(payload)
+    with ThreadPoolExecutor(1) as executor:
+        f = ZstdDecompressionFilter(executor=executor, offload_size=1)
+        assert _decompress(f, compressed) == payload
+
+
+def test_zstd_decompress_inline():
+    payload = b"smf" * 10000
+    compressed = zstd.ZstdCompressor().compress(payload)
+    f = ZstdDecompressionFilter()
+    assert _decompress(f, compressed) == payload
+
+
+def _samples():
+    return [
+        '{{"id": {}, "name": "user{}", "active": true}}'.format(
+            i, i % 7).encode() for i in range(1000)
+    ]
+
+
+def test_zstd_dictionary_round_trip(tmpdir):
+    samples = _samples()
+    dictionaries = ZstdDictionaries()
+    dictionaries.train(3, samples, dict_size=4096)
+    assert dictionaries.for_meta(3).dict_id() == 3
+    dictionaries.save(str(tmpdir))
+    loaded = ZstdDictionaries.load(str(tmpdir))
+
+    compress = ZstdCompressionFilter(1 << 20, dictionaries=dictionaries)
+    decompress = ZstdDecompressionFilter(dictionaries=loaded)
+    for payload in samples[:10]:
+        ctx = _Context(payload, 3, 1)
+        compress(ctx)
+        assert ctx.compression == COMPRESSION_ZSTD
+        assert zstd.get_frame_parameters(ctx.payload).dict_id == 3
+        assert _decompress(decompress, ctx.payload) == payload
@@ -0,0 +1,30 @@
+import asyncio
+
+from aiosmf.protocol import SMFProtocol
+
+
+class _Transport(asyncio.Transport):
+
+    def is_closing(self):
+        return False
+
+
+def test_cancelled_drain_leaves_other_waiters():
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        protocol = SMFProtocol()
+        protocol.connection_made(_Transport())
+        protocol.pause_writing()
+        cancelled = loop.create_task(protocol.drain())
+        waiting = loop.create_task(protocol.drain())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        later = loop.create_task(protocol.drain())
+        await asyncio.sleep(0.01)
+        assert cancelled.cancelled()
+        assert not waiting.done() and not later.done()
+        protocol.resume_writing()
+        await asyncio.gather(waiting, later)
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from aiosmf.loopback import create_loopback_connection
+from aiosmf.server import STATUS_ERROR, SMFServer
+
+
+class _FailingFilter:
+    """Outgoing filter failing for replies of status 200."""
+
+    def __call__(self, ctx):
+        if ctx.meta == 200:
+            raise ValueError("filter failed")
+
+
+async def _bare_payload(ctx):
+    return b"reply"
+
+
+async def _str_payload(ctx):
+    return "reply", 200
+
+
+async def _ok(ctx):
+    return b"reply", 200
+
+
+def _call(handler, **kwargs):
+
+    async def run():
+        server = SMFServer({1: handler}, **kwargs)
+        conn = await create_loopback_connection(server)
+        try:
+            return await asyncio.wait_for(conn.call(b"request", 1), 5)
+        finally:
+            conn.close()
+            await conn.wait_closed()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("handler", [_bare_payload, _str_payload])
+def test_invalid_handler_result(handler):
+    payload, status = _call(handler)
+    assert status == STATUS_ERROR
+    assert b"expected a (bytes, status[, headers]) tuple" in payload
+
+
+def test_reply_filter_failure():
+    payload, status = _call(_ok, outgoing_filters=(_FailingFilter(), ))
+    assert status == STATUS_ERROR
+    assert payload == b"ValueError: filter failed"
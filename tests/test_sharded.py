@@ -0,0 +1,14 @@
+import asyncio
+
+import pytest
+
+import aiosmf
+
+
+def test_thread_shards_reject_shared_filters():
+    filters = (aiosmf.ZstdCompressionFilter(1024), )
+    with pytest.raises(ValueError):
+        asyncio.run(
+            aiosmf.create_sharded_client("127.0.0.1:1",
+                                         shards=2,
+                                         outgoing_filters=filters))
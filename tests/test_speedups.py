@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from aiosmf import frame
+from aiosmf.util import payload_hasher, hasher_checksum, _speedups
+from aiosmf.frame import ChecksumError, FrameReader, build_header, pack_header
+
+pytestmark = pytest.mark.skipif(_speedups is None,
+                                reason="aiosmf._speedups is not built")
+
+SIZES = [1, 15, 16, 17, 255, 4096, 65537]
+
+
+def _checksum(data):
+    hasher = payload_hasher()
+    hasher.update(data)
+    return hasher_checksum(hasher)
+
+
+def _stream(sizes):
+    data = bytearray()
+    for i, size in enumerate(sizes):
+        payload = os.urandom(size)
+        data += pack_header(0, 0, i, size, _checksum(payload), 7)
+        data += payload
+    return bytes(data)
+
+
+def _parse(data, chunk, verify_limit=None):
+    frames = []
+    reader = FrameReader(verify_limit=verify_limit)
+    for pos in range(0, len(data), chunk):
+        reader.feed(data[pos:pos + chunk], lambda *args: frames.append(args))
+    return frames
+
+
+@pytest.mark.parametrize("size", [0] + SIZES)
+def test_checksum(size):
+    data = os.urandom(size)
+    assert _speedups.checksum(data) == _checksum(data)
+    assert _speedups.checksum(bytearray(data)) == _checksum(data)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_encode_header(monkeypatch, size):
+    payload = os.urandom(size)
+    header = build_header(1, 42, payload, 3647565230)
+    monkeypatch.setattr(frame, "_speedups", None)
+    assert header == build_header(1, 42, payload, 3647565230)
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 16, 1000, 1 << 20])
+@pytest.mark.parametrize("verify_limit", [None, 256])
+def test_parse_frames(monkeypatch, chunk, verify_limit):
+    data = _stream(SIZES * 2)
+    frames = _parse(data, chunk, verify_limit)
+    monkeypatch.setattr(frame, "_speedups", None)
+    assert frames == _parse(data, chunk, verify_limit)
+    assert len(frames) == len(SIZES) * 2
+
+
+def test_parse_frames_checksum_error(monkeypatch):
+    data = bytearray(_stream(SIZES))
+    data[-1] ^= 1
+    with pytest.raises(ChecksumError) as fast:
+        _parse(bytes(data), len(data))
+    monkeypatch.setattr(frame, "_speedups", None)
+    with pytest.raises(ChecksumError) as slow:
+        _parse(bytes(data), len(data))
+    assert str(fast.value) == str(slow.value)